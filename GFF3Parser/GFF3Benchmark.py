@@ -0,0 +1,396 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS is then reported as null
+    resource = None
+
+from GFF3Parser import GFF3Parser
+from GFF3OffsetIndex import GFF3OffsetIndex
+from GFF3ParseCache import GetCachePath, WriteCache
+from GFF3Exporter import ExportNDJSON
+from GFF3Stats import ComputeStats
+import sjh_gff3_parser
+
+# parser benchmark suite.
+# GenerateGFF3 writes a deterministic synthetic annotation (same arguments, same
+# bytes), and every benchmark then runs in its own freshly spawned process, so
+# its peak RSS is its own and no state (parse cache, offset index, interned
+# strings) leaks from one benchmark into the next. the report is one JSON
+# document with lines/sec, peak RSS and per-phase timings of every benchmark;
+# query benchmarks, whose time does not grow with the file, report
+# operations/sec of their query phases instead of lines/sec:
+#   python GFF3Benchmark.py --genes 20000 --output bench.json
+# or, for a fixed file:
+#   python GFF3Benchmark.py --input annotation.gff3
+
+g_benchmark_version = 3
+
+
+# write a synthetic GFF3 file: genes spread over `seqids` sequences, each with
+# `transcripts` mRNAs of `exons` exons and as many CDS, and `attributes` extra
+# key=value pairs per line. with `fasta` set, a "##FASTA" section with that many
+# bases per sequence follows the features. returns the number of feature lines.
+def GenerateGFF3(filePath, genes = 10000, transcripts = 2, exons = 5, attributes = 2, seqids = 4, seed = 0, fasta = 0):
+    rng = random.Random(seed)
+    lines = 0
+
+    def Attributes(base):
+        extra = ";".join("note%d=%s" % (i, "".join(rng.choice("acgt") for _ in range(8))) for i in range(attributes))
+        return base + ";" + extra if extra else base
+
+    with open(filePath, mode='w', encoding='utf-8', newline='\n') as f:
+        f.write("##gff-version 3\n")
+
+        position = { "chr%d" % (i + 1) : 1 for i in range(seqids) }
+        for g in range(genes):
+            seqid = "chr%d" % (g % seqids + 1)
+            strand = rng.choice("+-")
+            start = position[seqid] + rng.randint(500, 5000)
+
+            # exon layout shared by the transcripts, which skip some exons
+            exonParts = []
+            cursor = start
+            for e in range(exons):
+                exonParts.append((cursor, cursor + rng.randint(50, 400)))
+                cursor = exonParts[-1][1] + rng.randint(80, 3000)
+            end = exonParts[-1][1]
+            position[seqid] = end
+
+            geneID = "gene%07d" % g
+            f.write("\t".join((seqid, "synthetic", "gene", str(start), str(end), ".", strand, ".",
+                               Attributes("ID=" + geneID + ";Name=G" + str(g)))) + "\n")
+            lines += 1
+
+            for t in range(transcripts):
+                rnaID = "rna%07d.%d" % (g, t)
+                parts = [p for i, p in enumerate(exonParts) if i in (0, exons - 1) or rng.random() > 0.2]
+                f.write("\t".join((seqid, "synthetic", "mRNA", str(parts[0][0]), str(parts[-1][1]), ".", strand, ".",
+                                   Attributes("ID=" + rnaID + ";Parent=" + geneID))) + "\n")
+                lines += 1
+
+                for i, (s, e) in enumerate(parts):
+                    f.write("\t".join((seqid, "synthetic", "exon", str(s), str(e), ".", strand, ".",
+                                       Attributes("ID=exon-" + rnaID + "-" + str(i + 1) + ";Parent=" + rnaID))) + "\n")
+                    f.write("\t".join((seqid, "synthetic", "CDS", str(s), str(e), ".", strand, str(rng.randint(0, 2)),
+                                       Attributes("ID=cds-" + rnaID + ";Parent=" + rnaID))) + "\n")
+                    lines += 2
+
+            f.write("###\n")
+
+        if (fasta > 0):
+            f.write("##FASTA\n")
+            for seqid in position:
+                f.write(">" + seqid + "\n")
+                for i in range(0, fasta, 60):
+                    f.write("".join(rng.choice("ACGT") for _ in range(min(60, fasta - i))) + "\n")
+
+    return lines
+
+
+# wall-clock time of the named phases of one benchmark, and the number of
+# operations (queries, lookups) of the phases that count them.
+class PhaseTimer:
+
+    def __init__(self):
+        self.phases = {}
+        self.ops = {}
+
+    @contextlib.contextmanager
+    def Phase(self, name, ops = None):
+        if (ops is not None):
+            self.ops[name] = self.ops.get(name, 0) + ops
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def RemoveSidecars(filePath):
+    for path in (GFF3OffsetIndex.GetIndexPath(filePath), GetCachePath(filePath)):
+        if (os.path.exists(path)):
+            os.remove(path)
+
+
+def GetGeneIDs(filePath, count):
+    geneIDs = []
+    with GFF3Parser.OpenFile(filePath) as fs:
+        for strs in GFF3Parser.IterFields(fs):
+            if (strs[2] == "gene"):
+                geneIDs.append(sjh_gff3_parser.GetID(strs[8]))
+    step = max(1, len(geneIDs) // max(1, count))
+    return geneIDs[::step][:count]
+
+
+def BenchGetLineOfFileStream(filePath, timer):
+    with timer.Phase("parse"):
+        parser = GFF3Parser()
+        with GFF3Parser.OpenFile(filePath) as fs:
+            parser.GetLineOfFileStream(fs)
+
+
+def BenchGetLineOfFileParallel(filePath, timer):
+    with timer.Phase("parse"):
+        GFF3Parser().GetLineOfFileParallel(filePath)
+
+
+def BenchIterGenes(filePath, timer):
+    with timer.Phase("parse"):
+        with GFF3Parser.OpenFile(filePath) as fs:
+            for gene in GFF3Parser.IterGenes(fs):
+                pass
+
+
+def BenchLoadStore(filePath, timer):
+    RemoveSidecars(filePath)
+    with timer.Phase("parse"):
+        with GFF3Parser.OpenFile(filePath) as fs:
+            store = GFF3Parser.FillStore(fs)
+    with timer.Phase("columns"):
+        store.GetColumn("start")
+    with timer.Phase("writeCache"):
+        WriteCache(store, filePath)
+    with timer.Phase("readCache"):
+        store = GFF3Parser.LoadStore(filePath)
+    with timer.Phase("select"):
+        store.Select(type = "CDS", minLength = 100)
+    RemoveSidecars(filePath)
+
+
+def BenchSjhGetItems(filePath, timer):
+    with timer.Phase("parse"):
+        sjh_gff3_parser.GetItems(filePath)
+
+
+def BenchSjhGffParser(filePath, timer, queries = 100):
+    geneIDs = GetGeneIDs(filePath, queries)
+    RemoveSidecars(filePath)
+    with contextlib.redirect_stdout(io.StringIO()):
+        with timer.Phase("firstQuery", 1):
+            sjh_gff3_parser.GffParser(geneIDs[0], filePath)
+        with timer.Phase("indexedQueries", len(geneIDs)):
+            for geneID in geneIDs:
+                sjh_gff3_parser.GffParser(geneID, filePath)
+    RemoveSidecars(filePath)
+
+
+def BenchSjhGetGeneStructures(filePath, timer):
+    with timer.Phase("parse"):
+        sjh_gff3_parser.GetGeneStructures(None, filePath)
+
+
+def BenchOffsetIndex(filePath, timer, queries = 1000):
+    geneIDs = GetGeneIDs(filePath, queries)
+    with timer.Phase("build"):
+        index = GFF3OffsetIndex(filePath)
+        index.Build()
+    with timer.Phase("lookups", len(geneIDs)):
+        for geneID in geneIDs:
+            sjh_gff3_parser.GetGeneStructure(geneID, index)
+
+
+def BenchStats(filePath, timer):
+    with timer.Phase("stats"):
+        ComputeStats(filePath, processes = 1).GetSummary()
+
+
+def BenchExportNDJSON(filePath, timer):
+    with timer.Phase("export"):
+        with GFF3Parser.OpenFile(filePath) as fs, open(os.devnull, mode='w', encoding='utf-8') as out:
+            ExportNDJSON(fs, out)
+
+
+g_benchmarks = {
+    "GFF3Parser.GetLineOfFileStream" : BenchGetLineOfFileStream,
+    "GFF3Parser.GetLineOfFileParallel" : BenchGetLineOfFileParallel,
+    "GFF3Parser.IterGenes" : BenchIterGenes,
+    "GFF3Parser.LoadStore" : BenchLoadStore,
+    "sjh_gff3_parser.GetItems" : BenchSjhGetItems,
+    "sjh_gff3_parser.GffParser" : BenchSjhGffParser,
+    "sjh_gff3_parser.GetGeneStructures" : BenchSjhGetGeneStructures,
+    "GFF3OffsetIndex" : BenchOffsetIndex,
+    "GFF3Stats.ComputeStats" : BenchStats,
+    "GFF3Exporter.ExportNDJSON" : BenchExportNDJSON,
+    }
+
+
+def GetPeakRSS():
+    if (resource is None):
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# runs in the spawned process of one benchmark; the result, or the traceback
+# of a failure, is put on results. (a plain Process, not a Pool worker, as the
+# benchmarked code may start its own process pool.)
+def RunBenchmark(name, filePath, results):
+    try:
+        timer = PhaseTimer()
+        start = time.perf_counter()
+        g_benchmarks[name](filePath, timer)
+        seconds = time.perf_counter() - start
+        results.put({ "seconds" : seconds, "phases" : timer.phases, "ops" : timer.ops, "peakRSS" : GetPeakRSS() })
+    except Exception:
+        results.put({ "error" : traceback.format_exc() })
+
+
+# run one benchmark in a fresh process and return its result dict, which has an
+# "error" instead of timings if the benchmark raised, the process died without
+# a result, or it ran longer than timeout seconds.
+def RunBenchmarkProcess(context, name, filePath, timeout = None):
+    results = context.Queue()
+    process = context.Process(target=RunBenchmark, args=(name, filePath, results))
+    process.start()
+
+    start = time.perf_counter()
+    run = None
+    while (run is None):
+        try:
+            run = results.get(timeout=1.0)
+        except queue.Empty:
+            if (not process.is_alive()):
+                # it may have put its result just before exiting
+                try:
+                    run = results.get(timeout=1.0)
+                except queue.Empty:
+                    run = { "error" : "process exited with code %s" % process.exitcode }
+            elif (timeout is not None and time.perf_counter() - start > timeout):
+                process.terminate()
+                run = { "error" : "timed out after %g seconds" % timeout }
+
+    process.join()
+    return run
+
+
+# parse filePath serially and in a process pool and compare the results item by
+# item; returns the list of parentIDs whose groups differ.
+def CheckParallelParse(filePath, processes = 2, chunks = 50):
+    stream = GFF3Parser()
+    with GFF3Parser.OpenFile(filePath) as fs:
+        stream.GetLineOfFileStream(fs)
+    parallel = GFF3Parser()
+    parallel.GetLineOfFileParallel(filePath, processes, chunks)
+
+    def Rows(gene):
+        return [(item.mark, item.type, item.startIdx, item.endIdx, item.info) for item in gene.children]
+
+    return sorted(parentID for parentID in set(stream.items) | set(parallel.items)
+                  if parentID not in stream.items or parentID not in parallel.items
+                  or Rows(stream.items[parentID]) != Rows(parallel.items[parentID]))
+
+
+def CountLines(filePath):
+    with GFF3Parser.OpenFile(filePath) as fs:
+        return sum(1 for strs in GFF3Parser.IterFields(fs))
+
+
+# run the named benchmarks (all by default) on filePath, each `repeat` times in
+# a fresh process, and return the report dict; the fastest run is reported.
+# failed runs are reported with their errors, and a benchmark without any
+# successful run has null timings. benchmarks that count operations get
+# opsPerSecond (phase -> operations/sec) and a null linesPerSecond.
+def RunBenchmarks(filePath, names = None, repeat = 1, config = None, timeout = None):
+    names = list(g_benchmarks.keys()) if names is None else names
+    lines = CountLines(filePath)
+
+    report = {
+        "version" : g_benchmark_version,
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "cpus" : os.cpu_count(),
+        "config" : config,
+        "file" : { "path" : filePath, "bytes" : os.path.getsize(filePath), "lines" : lines },
+        "results" : [],
+        }
+
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        runs = [RunBenchmarkProcess(context, name, filePath, timeout) for i in range(repeat)]
+        errors = [run["error"] for run in runs if "error" in run]
+        runs = [run for run in runs if "error" not in run]
+        for error in errors:
+            print("benchmark", name, "failed:", error, file=sys.stderr)
+
+        result = { "name" : name, "seconds" : None, "linesPerSecond" : None, "opsPerSecond" : None,
+                   "peakRSS" : None, "phases" : None }
+        if (runs):
+            best = min(runs, key=lambda run: run["seconds"])
+            if (best["ops"]):
+                result["opsPerSecond"] = { phase : ops / best["phases"][phase] if best["phases"][phase] > 0 else None
+                                           for phase, ops in best["ops"].items() }
+            elif (best["seconds"] > 0):
+                result["linesPerSecond"] = lines / best["seconds"]
+            result.update({
+                "seconds" : best["seconds"],
+                "peakRSS" : max((run["peakRSS"] for run in runs if run["peakRSS"] is not None), default=None),
+                "phases" : best["phases"],
+                })
+        result["runs"] = [run["seconds"] for run in runs]
+        result["errors"] = errors
+        report["results"].append(result)
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the GFF3 parsers on a synthetic or given annotation")
+    parser.add_argument("--input", help="benchmark this GFF3 file instead of a synthetic one")
+    parser.add_argument("--genes", type=int, default=10000)
+    parser.add_argument("--transcripts", type=int, default=2, help="transcripts per gene")
+    parser.add_argument("--exons", type=int, default=5, help="exons per transcript")
+    parser.add_argument("--attributes", type=int, default=2, help="extra attributes per line")
+    parser.add_argument("--seqids", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fasta", type=int, default=0, help="bases per sequence of a trailing ##FASTA section")
+    parser.add_argument("--check", action="store_true", help="check that the parallel and stream parsers agree before benchmarking")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per benchmark, the fastest is reported")
+    parser.add_argument("--only", nargs="+", choices=list(g_benchmarks.keys()), help="benchmarks to run")
+    parser.add_argument("--timeout", type=float, help="seconds after which a benchmark run is stopped and reported as failed")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    # benchmarks create and remove sidecar files next to their input, so they
+    # always run on a copy in a scratch directory
+    workDir = tempfile.mkdtemp(prefix="gff3bench")
+    if (args.input):
+        filePath = os.path.join(workDir, os.path.basename(args.input))
+        shutil.copyfile(args.input, filePath)
+        config = { "input" : os.path.abspath(args.input) }
+    else:
+        filePath = os.path.join(workDir, "synthetic.gff3")
+        config = { "genes" : args.genes, "transcripts" : args.transcripts, "exons" : args.exons,
+                   "attributes" : args.attributes, "seqids" : args.seqids, "seed" : args.seed, "fasta" : args.fasta }
+        GenerateGFF3(filePath, **config)
+
+    try:
+        if (args.check):
+            mismatches = CheckParallelParse(filePath)
+            if (mismatches):
+                sys.exit("parallel parse differs from stream parse for %d groups, e.g. %s" % (len(mismatches), mismatches[:5]))
+        report = RunBenchmarks(filePath, args.only, args.repeat, config, args.timeout)
+    finally:
+        shutil.rmtree(workDir)
+
+    text = json.dumps(report, indent=2)
+    if (args.output):
+        with open(args.output, mode='w', encoding='utf-8') as out:
+            out.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,209 @@
+import gzip
+import io
+import struct
+import zlib
+
+from bisect import bisect_right
+from collections import OrderedDict
+
+# transparent access to plain, gzip and BGZF compressed GFF3 files.
+# BGZF (bgzip) files are a series of small gzip members whose sizes are stored in
+# their headers, so a block offset index can be built without decompressing
+# anything, and a seek only decompresses the block that holds the target offset.
+# all offsets used here are offsets into the uncompressed text.
+
+g_gzip_magic = b"\x1f\x8b"
+g_bgzf_cache_size = 64
+
+
+def IsGzipFile(filePath):
+    with open(filePath, mode='rb') as f:
+        return f.read(2) == g_gzip_magic
+
+
+# parse a gzip member header at the current position of f.
+# returns (header size, BSIZE) where BSIZE is None if it is not a BGZF block,
+# or None at the end of the file.
+def ReadBlockHeader(f):
+    header = f.read(12)
+    if (len(header) < 12):
+        return None
+    if (header[:2] != g_gzip_magic or not (header[3] & 4)):
+        return (len(header), None)
+
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = f.read(xlen)
+
+    # walk the extra subfields looking for the "BC" one
+    i = 0
+    while (i + 4 <= len(extra)):
+        slen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+        if (extra[i:i + 2] == b"BC" and slen == 2):
+            return (12 + xlen, struct.unpack("<H", extra[i + 4:i + 6])[0] + 1)
+        i += 4 + slen
+
+    return (12 + xlen, None)
+
+
+def IsBGZFFile(filePath):
+    with open(filePath, mode='rb') as f:
+        header = ReadBlockHeader(f)
+    return header is not None and header[1] is not None
+
+
+# block offset index of a BGZF file: the compressed offset of every block and the
+# uncompressed offset it starts at; only the headers and ISIZE fields are read.
+def GetBGZFBlocks(filePath):
+    coffsets = []
+    uoffsets = []
+
+    coffset = 0
+    uoffset = 0
+    with open(filePath, mode='rb') as f:
+        while True:
+            f.seek(coffset)
+            header = ReadBlockHeader(f)
+            if (header is None or header[1] is None):
+                break
+
+            bsize = header[1]
+            f.seek(coffset + bsize - 4)
+            isize = struct.unpack("<I", f.read(4))[0]
+            if (isize > 0):
+                coffsets.append(coffset)
+                uoffsets.append(uoffset)
+
+            coffset += bsize
+            uoffset += isize
+
+    return coffsets, uoffsets, uoffset
+
+
+# binary, seekable reader over the uncompressed content of a BGZF file.
+class BGZFReader(io.RawIOBase):
+
+    def __init__(self, filePath, blocks = None):
+        super().__init__()
+        self.f = open(filePath, mode='rb')
+        if (blocks is None):
+            blocks = GetBGZFBlocks(filePath)
+        self.coffsets, self.uoffsets, self.size = blocks
+
+        self.cache = OrderedDict()
+        self.blockIdx = -1
+        self.block = b""
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if (not self.closed):
+            self.f.close()
+        super().close()
+
+    # decompress block i, keeping the most recently used blocks around (LRU).
+    def LoadBlock(self, i):
+        block = self.cache.get(i)
+        if (block is not None):
+            self.cache.move_to_end(i)
+        else:
+            start = self.coffsets[i]
+            self.f.seek(start)
+            headerSize, bsize = ReadBlockHeader(self.f)
+            self.f.seek(start + headerSize)
+            block = zlib.decompress(self.f.read(bsize - headerSize - 8), -15)
+            if (len(self.cache) >= g_bgzf_cache_size):
+                self.cache.popitem(last=False)
+            self.cache[i] = block
+
+        self.blockIdx = i
+        self.block = block
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if (whence == io.SEEK_CUR):
+            offset += self.tell()
+        elif (whence == io.SEEK_END):
+            offset += self.size
+
+        offset = max(0, min(offset, self.size))
+        i = bisect_right(self.uoffsets, offset) - 1
+        if (i < 0):
+            self.blockIdx = -1
+            self.block = b""
+            self.pos = 0
+            return 0
+
+        if (i != self.blockIdx):
+            self.LoadBlock(i)
+        self.pos = offset - self.uoffsets[i]
+        return offset
+
+    def tell(self):
+        if (self.blockIdx < 0):
+            return 0
+        return self.uoffsets[self.blockIdx] + self.pos
+
+    # move to the next block once the current one is exhausted.
+    def NextBlock(self):
+        if (self.blockIdx + 1 >= len(self.coffsets)):
+            return False
+        self.LoadBlock(self.blockIdx + 1)
+        self.pos = 0
+        return True
+
+    def readline(self, size = -1):
+        parts = []
+        while True:
+            if (self.pos >= len(self.block) and not self.NextBlock()):
+                break
+
+            end = self.block.find(b"\n", self.pos)
+            if (end >= 0):
+                parts.append(self.block[self.pos:end + 1])
+                self.pos = end + 1
+                break
+
+            parts.append(self.block[self.pos:])
+            self.pos = len(self.block)
+
+        return b"".join(parts)
+
+    def read(self, size = -1):
+        parts = []
+        while (size < 0 or size > 0):
+            if (self.pos >= len(self.block) and not self.NextBlock()):
+                break
+
+            end = len(self.block) if size < 0 else min(len(self.block), self.pos + size)
+            parts.append(self.block[self.pos:end])
+            if (size > 0):
+                size -= end - self.pos
+            self.pos = end
+
+        return b"".join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# seekable binary stream over the uncompressed content of any supported file.
+def OpenBinary(filePath, blocks = None):
+    if (IsGzipFile(filePath)):
+        if (IsBGZFFile(filePath)):
+            return BGZFReader(filePath, blocks)
+        # plain gzip seeks by decompressing from the start
+        return gzip.open(filePath, mode='rb')
+    return open(filePath, mode='rb')
+
+
+# text stream for sequential parsing; multi-member BGZF is valid gzip.
+def OpenText(filePath):
+    if (IsGzipFile(filePath)):
+        return gzip.open(filePath, mode='rt', encoding='utf-8')
+    return open(filePath, mode='r', encoding='utf-8')
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+
+from urllib.request import pathname2url
+
+import GFF3ParserGlobalDefs
+from GFF3Parser import GFF3Parser
+from GFF3Utils import GFF3Attributes
+from sjh_gff3_parser import GetStructureItem
+
+# on-disk SQLite feature database of a GFF3 file.
+# ImportGFF3 loads the file once; any number of processes can then open the
+# database read-only and query it without holding a parsed copy in memory.
+# features are stored in file order (id), multi-valued Parent in a separate
+# relations table, and coordinates in an integer R*-tree keyed by a seqid code
+# so range queries do not scan the table.
+
+g_batch_size = 50000
+
+g_schema = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE seqids (code INTEGER PRIMARY KEY, seqid TEXT UNIQUE);
+CREATE TABLE features (
+    id INTEGER PRIMARY KEY,
+    seqid TEXT,
+    source TEXT,
+    type TEXT,
+    startIdx INTEGER,
+    endIdx INTEGER,
+    score TEXT,
+    strand TEXT,
+    phase TEXT,
+    featureID TEXT,
+    attributes TEXT
+    );
+CREATE TABLE relations (child INTEGER, parentID TEXT);
+CREATE VIRTUAL TABLE features_rtree USING rtree_i32(id, seqMin, seqMax, startIdx, endIdx);
+"""
+
+# created after the bulk insert, which is much faster than maintaining them
+g_indexes = """
+CREATE INDEX features_featureID ON features(featureID);
+CREATE INDEX features_type ON features(type);
+CREATE INDEX features_seqid ON features(seqid, startIdx);
+CREATE INDEX relations_parentID ON relations(parentID, child);
+CREATE INDEX relations_child ON relations(child);
+"""
+
+g_columns = "f.seqid, f.source, f.type, f.startIdx, f.endIdx, f.score, f.strand, f.phase, f.attributes, f.featureID"
+
+
+# load filePath (plain or compressed) into a new database at dbPath; an existing
+# database at dbPath is replaced. rows are inserted in transactions of batchSize.
+def ImportGFF3(filePath, dbPath, batchSize = g_batch_size):
+    if (os.path.exists(dbPath)):
+        os.remove(dbPath)
+
+    connection = sqlite3.connect(dbPath)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.executescript(g_schema)
+
+    seqids = {}
+    features = []
+    relations = []
+    rtree = []
+
+    def Flush():
+        with connection:
+            connection.executemany("INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", features)
+            connection.executemany("INSERT INTO relations VALUES (?, ?)", relations)
+            connection.executemany("INSERT INTO features_rtree VALUES (?, ?, ?, ?, ?)", rtree)
+        features.clear()
+        relations.clear()
+        rtree.clear()
+
+    with GFF3Parser.OpenFile(filePath) as fs:
+        for rowID, strs in enumerate(GFF3Parser.IterFields(fs)):
+            attributes = GFF3Attributes(strs[8])
+            start = int(strs[3])
+            end = int(strs[4])
+
+            code = seqids.setdefault(strs[0], len(seqids))
+            features.append((rowID, strs[0], strs[1], strs[2], start, end, strs[5], strs[6], strs[7],
+                             attributes.GetID(), strs[8]))
+            for parentID in (attributes.GetParentIDs() or [""]):
+                relations.append((rowID, parentID))
+            rtree.append((rowID, code, code, start, end))
+
+            if (len(features) >= batchSize):
+                Flush()
+
+    Flush()
+
+    stat = os.stat(filePath)
+    with connection:
+        connection.executemany("INSERT INTO seqids VALUES (?, ?)", [(c, s) for s, c in seqids.items()])
+        connection.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("source", os.path.abspath(filePath)),
+            ("size", str(stat.st_size)),
+            ("mtime", str(stat.st_mtime_ns)),
+            ])
+        connection.executescript(g_indexes)
+        connection.execute("ANALYZE")
+
+    connection.close()
+
+
+class GFF3Database:
+
+    # readOnly connections can be opened by many processes at the same time.
+    def __init__(self, dbPath, readOnly = True):
+        if (readOnly):
+            self.connection = sqlite3.connect("file:" + pathname2url(os.path.abspath(dbPath)) + "?mode=ro", uri=True)
+        else:
+            self.connection = sqlite3.connect(dbPath)
+
+        self.seqids = dict(self.connection.execute("SELECT seqid, code FROM seqids"))
+
+    def Close(self):
+        self.connection.close()
+
+    # rows are returned as the 9 GFF3 columns followed by the feature ID.
+    def Query(self, where, args):
+        sql = "SELECT " + g_columns + " FROM features f " + where
+        return [[str(v) if i < 9 else v for i, v in enumerate(row)]
+                for row in self.connection.execute(sql, args)]
+
+    def GetFeatures(self, ID):
+        return self.Query("WHERE f.featureID = ? ORDER BY f.id", (ID,))
+
+    def GetChildren(self, parentID):
+        return self.Query("JOIN relations r ON r.child = f.id WHERE r.parentID = ? ORDER BY f.id", (parentID,))
+
+    # features overlapping seqid:[start, end], optionally of the given types.
+    def GetRegion(self, seqid, start, end, types = None):
+        code = self.seqids.get(seqid)
+        if (code is None):
+            return []
+
+        where = ("JOIN features_rtree t ON t.id = f.id "
+                 "WHERE t.seqMin <= ? AND t.seqMax >= ? AND t.endIdx >= ? AND t.startIdx <= ?")
+        args = [code, code, start, end]
+        if (types is not None):
+            types = list(types)
+            where += " AND f.type IN (" + ",".join("?" * len(types)) + ")"
+            args += types
+
+        return self.Query(where + " ORDER BY f.id", args)
+
+    # same dict as sjh_gff3_parser.GetGeneStructure / GffParser.
+    def GetGeneStructure(self, gene_id):
+        gene_structure = {}
+
+        for gene_line in self.GetFeatures(gene_id):
+            gene_structure = GetStructureItem(gene_line, gene_id)
+        if not gene_structure:
+            return gene_structure
+
+        for two_parser in self.GetChildren(gene_id):
+            two_item = GetStructureItem(two_parser, two_parser[9])
+
+            if two_parser[2] in GFF3ParserGlobalDefs.g_rna_types:
+                gene_structure['children'].append(two_item)
+                for three_info in self.GetChildren(two_item['name']):
+                    two_item['sub_feature'].append(GetStructureItem(three_info, three_info[9]))
+            else:
+                gene_structure['sub_feature'].append(two_item)
+
+        return gene_structure
+
+    def GetGeneStructures(self, gene_ids):
+        return {ID: self.GetGeneStructure(ID) for ID in gene_ids}
@@ -0,0 +1,193 @@
+import numpy
+
+from GFF3ParserGlobalDefs import *
+from GFF3Utils import Structure, RNAStructure
+
+# introns, UTRs and spliced lengths of every transcript of a GFF3FeatureStore,
+# derived at once from the exon/CDS columns.
+# exons are sorted by (transcript, start) with one lexsort, and everything else
+# is computed with diffs and reduceat over the transcript groups, so there is no
+# Python loop per transcript or per exon; only AttachDerivedFeatures builds
+# objects. transcripts are identified by the string code of their ID, which is
+# the parent code of their exons in the store's child -> parent relation; an
+# exon shared by several transcripts (Parent=a,b) is a part of each.
+# transcripts without exons take their introns and spliced length from their CDS.
+
+
+class DerivedFeatures:
+
+    def __init__(self):
+        # per transcript with at least one exon
+        self.transcripts = numpy.zeros(0, dtype=numpy.int64)
+        self.strands = numpy.zeros(0, dtype=numpy.int64)
+        self.splicedLengths = numpy.zeros(0, dtype=numpy.int64)
+
+        # per derived feature
+        self.intronParents = numpy.zeros(0, dtype=numpy.int64)
+        self.intronStarts = numpy.zeros(0, dtype=numpy.int64)
+        self.intronEnds = numpy.zeros(0, dtype=numpy.int64)
+        self.intronRanks = numpy.zeros(0, dtype=numpy.int64)
+
+        self.utrParents = numpy.zeros(0, dtype=numpy.int64)
+        self.utrStarts = numpy.zeros(0, dtype=numpy.int64)
+        self.utrEnds = numpy.zeros(0, dtype=numpy.int64)
+        self.utrFivePrime = numpy.zeros(0, dtype=bool)
+
+
+# (row, parent) pairs of the rows of the given type, sorted by (parent, start,
+# end); a row with several parents is in the result once per parent.
+def GetSortedChildren(store, type):
+    return GetSortedRows(store, store.GetMask("type", type)[store.GetColumn("childRow")])
+
+
+# exon pairs, and the CDS pairs of transcripts without exons, sorted as above.
+def GetSortedParts(store):
+    childRows = store.GetColumn("childRow")
+    parentCodes = store.GetColumn("parentCode")
+    exons = store.GetMask("type", g_exon_type)[childRows]
+    cds = store.GetMask("type", g_cds_type)[childRows] & ~numpy.isin(parentCodes, parentCodes[exons])
+    return GetSortedRows(store, exons | cds)
+
+
+# mask: over the entries of the child -> parent relation.
+def GetSortedRows(store, mask):
+    entries = numpy.flatnonzero(mask)
+    rows = store.GetColumn("childRow")[entries]
+    parents = store.GetColumn("parentCode")[entries]
+    starts = store.GetColumn("start")[rows]
+    ends = store.GetColumn("end")[rows]
+
+    order = numpy.lexsort((ends, starts, parents))
+    return rows[order], parents[order], starts[order], ends[order]
+
+
+# 1-based rank of every element in its run of equal, sorted keys.
+def GetRanks(keys):
+    first = numpy.searchsorted(keys, keys, side='left')
+    return numpy.arange(len(keys)) - first + 1, numpy.searchsorted(keys, keys, side='right') - first
+
+
+def DeriveFeatures(store):
+    derived = DerivedFeatures()
+
+    rows, parents, starts, ends = GetSortedParts(store)
+    if (len(rows) == 0):
+        return derived
+
+    groupStarts = numpy.flatnonzero(numpy.r_[True, parents[1:] != parents[:-1]])
+    derived.transcripts = parents[groupStarts]
+    derived.strands = store.GetColumn("strand")[rows[groupStarts]]
+
+    # overlapping exons of a transcript are merged before lengths and introns are
+    # taken: a running max end that restarts at every transcript, by offsetting
+    # each group past the largest coordinate.
+    offset = int(ends.max()) + 1
+    groupIdx = numpy.cumsum(numpy.r_[True, parents[1:] != parents[:-1]]) - 1
+    maxEnds = numpy.maximum.accumulate(ends + groupIdx * offset) - groupIdx * offset
+
+    same = parents[1:] == parents[:-1]
+    gaps = same & (starts[1:] > maxEnds[:-1] + 1)
+
+    # covered bases: each exon counts from past the previous running max end
+    covered = ends - starts + 1
+    overlap = numpy.zeros(len(rows), dtype=numpy.int64)
+    overlap[1:] = numpy.where(same, numpy.clip(maxEnds[:-1] - starts[1:] + 1, 0, None), 0)
+    overlap[1:] = numpy.minimum(overlap[1:], covered[1:])
+    derived.splicedLengths = numpy.add.reduceat(covered - overlap, groupStarts)
+
+    derived.intronParents = parents[:-1][gaps]
+    derived.intronStarts = maxEnds[:-1][gaps] + 1
+    derived.intronEnds = starts[1:][gaps] - 1
+
+    # introns are numbered in transcript order, i.e. backwards on the - strand
+    ranks, counts = GetRanks(derived.intronParents)
+    minus = store.pools["strand"].Find("-")
+    intronStrands = derived.strands[numpy.searchsorted(derived.transcripts, derived.intronParents)]
+    derived.intronRanks = numpy.where(intronStrands == minus, counts - ranks + 1, ranks)
+
+    # coding span of every transcript with CDS
+    cdsRows, cdsParents, cdsStarts, cdsEnds = GetSortedChildren(store, g_cds_type)
+    if (len(cdsRows) == 0):
+        return derived
+
+    cdsGroupStarts = numpy.flatnonzero(numpy.r_[True, cdsParents[1:] != cdsParents[:-1]])
+    codingParents = cdsParents[cdsGroupStarts]
+    codingStarts = numpy.minimum.reduceat(cdsStarts, cdsGroupStarts)
+    codingEnds = numpy.maximum.reduceat(cdsEnds, cdsGroupStarts)
+
+    # the parts of the merged exon blocks before and after the coding span are
+    # UTRs; taken from the exons themselves, overlapping exons would give
+    # overlapping UTRs. a block starts at every transcript and every intron.
+    blockFirsts = numpy.flatnonzero(numpy.r_[True, ~same | gaps])
+    blockParents = parents[blockFirsts]
+    blockStarts = starts[blockFirsts]
+    blockEnds = maxEnds[numpy.r_[blockFirsts[1:] - 1, len(rows) - 1]]
+    blockStrands = store.GetColumn("strand")[rows[blockFirsts]]
+
+    idx = numpy.clip(numpy.searchsorted(codingParents, blockParents), 0, len(codingParents) - 1)
+    coding = codingParents[idx] == blockParents
+
+    left = coding & (blockStarts < codingStarts[idx])
+    right = coding & (blockEnds > codingEnds[idx])
+
+    utrParents = numpy.concatenate((blockParents[left], blockParents[right]))
+    utrStarts = numpy.concatenate((blockStarts[left], numpy.maximum(blockStarts[right], codingEnds[idx][right] + 1)))
+    utrEnds = numpy.concatenate((numpy.minimum(blockEnds[left], codingStarts[idx][left] - 1), blockEnds[right]))
+    utrStrands = numpy.concatenate((blockStrands[left], blockStrands[right]))
+    isLeft = numpy.r_[numpy.ones(left.sum(), dtype=bool), numpy.zeros(right.sum(), dtype=bool)]
+
+    order = numpy.lexsort((utrStarts, utrParents))
+    derived.utrParents = utrParents[order]
+    derived.utrStarts = utrStarts[order]
+    derived.utrEnds = utrEnds[order]
+    derived.utrFivePrime = (isLeft != (utrStrands == minus))[order]
+
+    return derived
+
+
+def MakeStructure(type, name, strand, start, end):
+    structure = Structure()
+    structure.type = type
+    structure.name = name
+    structure.strand = strand
+    structure.start = int(start)
+    structure.end = int(end)
+    return structure
+
+
+# one RNAStructure per RNA row of the store, keyed by RNA ID, with the derived
+# introns and UTRs appended to its sub_features and its spliced length set.
+def AttachDerivedFeatures(store, derived, rnaStructures = None):
+    if (rnaStructures is None):
+        rnaStructures = {}
+        rows = numpy.flatnonzero(store.GetMask("type", list(g_rna_types)))
+        for row in rows:
+            rna = RNAStructure()
+            rna.type = store.GetValue("type", row)
+            rna.name = store.GetID(row)
+            rna.strand = store.GetValue("strand", row)
+            rna.start = int(store.GetColumn("start")[row])
+            rna.end = int(store.GetColumn("end")[row])
+            rnaStructures.setdefault(rna.name, rna)
+
+    strings = store.strings
+
+    for code, length in zip(derived.transcripts.tolist(), derived.splicedLengths.tolist()):
+        rna = rnaStructures.get(strings.Get(code))
+        if (rna is not None):
+            rna.splicedLength = length
+
+    for code, start, end, rank in zip(derived.intronParents.tolist(), derived.intronStarts.tolist(),
+                                      derived.intronEnds.tolist(), derived.intronRanks.tolist()):
+        rna = rnaStructures.get(strings.Get(code))
+        if (rna is not None):
+            rna.sub_features.append(MakeStructure(g_intron_type, "intron" + str(rank), rna.strand, start, end))
+
+    for code, start, end, fivePrime in zip(derived.utrParents.tolist(), derived.utrStarts.tolist(),
+                                           derived.utrEnds.tolist(), derived.utrFivePrime.tolist()):
+        rna = rnaStructures.get(strings.Get(code))
+        if (rna is not None):
+            type = g_five_prime_utr_type if fivePrime else g_three_prime_utr_type
+            rna.sub_features.append(MakeStructure(type, type, rna.strand, start, end))
+
+    return rnaStructures
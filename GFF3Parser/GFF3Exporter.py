@@ -0,0 +1,185 @@
+import json
+import os
+import sys
+
+import numpy
+
+import GFF3ParserGlobalDefs
+from GFF3Parser import GFF3Parser
+from GFF3FeatureStore import GFF3FeatureStore
+from GFF3DerivedFeatures import DeriveFeatures
+from sjh_gff3_parser import GetStructureItem
+
+# streaming JSON export of gene structures.
+# genes come from GFF3Parser.IterGenes, so they are converted and written as
+# soon as their block in the file ("###" or the end of the file) is complete.
+# the nested dicts have the layout sjh_gff3_parser.GffParser prints, plus
+# "intron" sub_features derived for every RNA by
+# GFF3DerivedFeatures.DeriveFeatures: the exons and CDS of the RNAs of
+# g_intron_batch consecutive genes go into one feature store, and the introns of
+# the batch are derived at once before it is written.
+# features that fit in no gene structure (not under a gene, or not a direct
+# child of a gene or of one of its RNAs) are never dropped silently: they are
+# collected in the caller's skipped list, or counted on stderr.
+
+g_intron_batch = 256
+
+
+# append the introns of the RNA children of a gene structure to their
+# sub_features, numbered in transcript order. store holds the parts (exons,
+# CDS) of the RNAs, one row per parent.
+def AddIntrons(rnas, store):
+    derived = DeriveFeatures(store)
+    strings = store.strings
+
+    order = numpy.lexsort((derived.intronRanks, derived.intronParents))
+    for code, start, end, rank in zip(derived.intronParents[order].tolist(), derived.intronStarts[order].tolist(),
+                                      derived.intronEnds[order].tolist(), derived.intronRanks[order].tolist()):
+        for rna_item in rnas.get(strings.Get(code), []):
+            rna_item['sub_feature'].append({
+                'type': GFF3ParserGlobalDefs.g_intron_type,
+                'start': str(start),
+                'end': str(end),
+                'strand': rna_item['strand'],
+                'name': "intron" + str(rank),
+                'children': [],
+                'sub_feature': [],
+                })
+
+
+# nested structure of one GFF3Gene group from GFF3Parser.IterGenes, or None if
+# the group is not rooted at a gene. the GFF3Items left out are appended to
+# skipped, if given.
+def GetGroupStructure(group, skipped = None):
+    rnas = {}
+    store = GFF3FeatureStore()
+    gene_structure = BuildGroupStructure(group, rnas, store, [] if skipped is None else skipped)
+    if gene_structure is not None and len(store):
+        AddIntrons(rnas, store)
+    return gene_structure
+
+
+# GetGroupStructure without the introns: the RNA structures are added to
+# batchRnas (RNA ID -> list of structures) and their parts to store, for
+# AddIntrons.
+def BuildGroupStructure(group, batchRnas, store, skipped):
+    root = group.children[0]
+    if root.parentID or root.typeCode not in GFF3ParserGlobalDefs.g_gene_type_codes:
+        skipped.extend(group.children)
+        return None
+
+    gene_structure = GetStructureItem(root.GetFields(), root.ID)
+    rnas = {}
+    pending = []
+
+    for item in group.children[1:]:
+        for parentID in item.parentIDs:
+            if parentID == root.ID:
+                two_item = GetStructureItem(item.GetFields(), item.ID)
+                if item.IsRNA():
+                    gene_structure['children'].append(two_item)
+                    # a discontinuous RNA has one line, and one copy, per part
+                    rnas.setdefault(item.ID, []).append(two_item)
+                else:
+                    gene_structure['sub_feature'].append(two_item)
+            else:
+                # the RNA may come later in the block
+                pending.append((item, parentID))
+
+    placed = set(id(item) for item in group.children[1:] if not item.parentIDs or root.ID in item.parentIDs)
+    for item, parentID in pending:
+        if parentID not in rnas:
+            continue
+        placed.add(id(item))
+        if item.typeCode in GFF3ParserGlobalDefs.g_exon_type_codes:
+            store.AppendFields(item.GetFields(), item.ID, [parentID])
+        for two_item in rnas[parentID]:
+            two_item['sub_feature'].append(GetStructureItem(item.GetFields(), item.ID))
+
+    skipped.extend(item for item in group.children[1:] if id(item) not in placed)
+
+    for ID, two_items in rnas.items():
+        batchRnas.setdefault(ID, []).extend(two_items)
+
+    return gene_structure
+
+
+# yield (seqid, gene structure) for every gene of the stream, in file order.
+# the GFF3Items that are in no gene structure are appended to skipped; without
+# a skipped list, their number is printed to stderr at the end.
+def IterGeneStructures(fs, skipped = None):
+    report = skipped is None
+    skipped = [] if skipped is None else skipped
+    batch = []
+    rnas = {}
+    store = GFF3FeatureStore()
+
+    for group in GFF3Parser.IterGenes(fs):
+        gene_structure = BuildGroupStructure(group, rnas, store, skipped)
+        if gene_structure is not None:
+            batch.append((group.children[0].mark, gene_structure))
+
+        if len(batch) >= g_intron_batch:
+            AddIntrons(rnas, store)
+            yield from batch
+            batch = []
+            rnas = {}
+            store = GFF3FeatureStore()
+
+    if len(store):
+        AddIntrons(rnas, store)
+    yield from batch
+
+    if report and skipped:
+        print("skipped %d features outside gene structures, e.g." % len(skipped),
+              ", ".join(item.ID or item.type for item in skipped[:5]), file=sys.stderr)
+
+
+def DumpStructure(gene_structure):
+    return json.dumps(gene_structure, sort_keys=True, ensure_ascii=False)
+
+
+# one gene structure per line.
+def ExportNDJSON(fs, out, skipped = None):
+    count = 0
+    for seqid, gene_structure in IterGeneStructures(fs, skipped):
+        out.write(DumpStructure(gene_structure))
+        out.write("\n")
+        count += 1
+    return count
+
+
+# a single JSON array, written element by element.
+def ExportJSONArray(fs, out, skipped = None):
+    count = 0
+    out.write("[")
+    for seqid, gene_structure in IterGeneStructures(fs, skipped):
+        out.write(",\n" if count else "\n")
+        out.write(DumpStructure(gene_structure))
+        count += 1
+    out.write("\n]\n")
+    return count
+
+
+# one NDJSON file per seqid in outDir, named <seqid>.ndjson.
+# returns a dict seqid -> output path.
+def ExportNDJSONPerSeqid(fs, outDir, skipped = None):
+    os.makedirs(outDir, exist_ok=True)
+
+    paths = {}
+    outs = {}
+    try:
+        for seqid, gene_structure in IterGeneStructures(fs, skipped):
+            out = outs.get(seqid)
+            if out is None:
+                name = "".join(c if c.isalnum() or c in "._-" else "_" for c in seqid)
+                paths[seqid] = os.path.join(outDir, name + ".ndjson")
+                out = open(paths[seqid], mode='w', encoding='utf-8')
+                outs[seqid] = out
+            out.write(DumpStructure(gene_structure))
+            out.write("\n")
+    finally:
+        for out in outs.values():
+            out.close()
+
+    return paths
@@ -0,0 +1,205 @@
+import mmap
+import os
+import tempfile
+
+from GFF3Compression import IsGzipFile, OpenBinary
+from GFF3Parser import GFF3Parser
+
+# lazy access to the sequences embedded after the "##FASTA" directive of a GFF3
+# file. Build seeks to the directive (found with a block search, not line by
+# line) and records, for every record, the byte offset of its first base and
+# its line layout; a fetch then computes the byte range of the wanted bases and
+# reads only that slice, through a memory map for plain files or a seekable
+# stream for compressed ones. no sequence is kept in memory.
+# the records are saved next to the source as <file>.fai, in the samtools .fai
+# columns (name, length, offset, line bases, line bytes) after one
+# "#GFF3FAI" line with the size and mtime of the source; Load rebuilds it when
+# those no longer match or it cannot be read. offsets are into the
+# uncompressed text.
+
+g_fai_suffix = ".fai"
+g_fai_magic = "#GFF3FAI"
+
+g_complement = bytes.maketrans(b"ACGTUNacgtunRYKMBVDHrykmbvdh", b"TGCAANtgcaanYRMKVBHDyrmkvbhd")
+
+
+class FastaRecord:
+
+    def __init__(self, name, offset):
+        self.name = name
+        self.offset = offset
+        self.length = 0
+        self.lineBases = 0
+        self.lineBytes = 0
+
+
+class GFF3FastaIndex:
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.records = {}
+        self.data = None
+        self.stream = None
+        self.compressed = IsGzipFile(filePath)
+
+    @staticmethod
+    def GetIndexPath(filePath):
+        return filePath + g_fai_suffix
+
+    # the index of filePath, read from its .fai file or (re)built and saved.
+    @staticmethod
+    def Load(filePath, save = True):
+        index = GFF3FastaIndex(filePath)
+        if (index.ReadIndex()):
+            return index
+
+        index.Build()
+        if (save):
+            index.WriteIndex()
+        return index
+
+    def Build(self):
+        self.records = {}
+        record = None
+        lastLine = False
+
+        with OpenBinary(self.filePath) as f:
+            offset = GFF3Parser.FindFastaOffset(f)
+            if (offset is None):
+                return
+            f.seek(offset)
+            offset += len(f.readline())
+
+            for line in f:
+                offset += len(line)
+
+                if (line.startswith(b">")):
+                    name = line[1:].split(None, 1)[0].decode('utf-8') if line[1:].strip() else ""
+                    record = FastaRecord(name, offset)
+                    self.records[name] = record
+                    lastLine = False
+                    continue
+
+                if (record is None):
+                    continue
+
+                bases = len(line.rstrip(b"\r\n"))
+                if (bases == 0):
+                    continue
+                # every line but the last one must be as long as the first
+                if (record.lineBases == 0):
+                    record.lineBases = bases
+                    record.lineBytes = len(line)
+                elif (lastLine or bases > record.lineBases or
+                      (bases == record.lineBases and len(line) != record.lineBytes and line.endswith(b"\n"))):
+                    raise ValueError("FASTA record " + record.name + " has lines of different lengths")
+                elif (bases < record.lineBases):
+                    lastLine = True
+                record.length += bases
+
+    # load the records from the .fai file; False if it is missing, cannot be
+    # read or was written for another version of the source.
+    def ReadIndex(self):
+        indexPath = GFF3FastaIndex.GetIndexPath(self.filePath)
+        if (not os.path.isfile(indexPath)):
+            return False
+
+        stat = os.stat(self.filePath)
+        records = {}
+        try:
+            with open(indexPath, mode='r', encoding='utf-8') as f:
+                if (f.readline().rstrip("\n").split("\t") != [g_fai_magic, str(stat.st_size), str(stat.st_mtime_ns)]):
+                    return False
+                for line in f:
+                    name, length, offset, lineBases, lineBytes = line.rstrip("\n").split("\t")
+                    record = FastaRecord(name, int(offset))
+                    record.length = int(length)
+                    record.lineBases = int(lineBases)
+                    record.lineBytes = int(lineBytes)
+                    records[name] = record
+        except (OSError, ValueError):
+            return False
+
+        self.records = records
+        return True
+
+    # save the records as <file>.fai, through a temporary file renamed into place.
+    def WriteIndex(self):
+        stat = os.stat(self.filePath)
+        indexPath = GFF3FastaIndex.GetIndexPath(self.filePath)
+        try:
+            fd, tempPath = tempfile.mkstemp(prefix=os.path.basename(indexPath) + ".", suffix=".tmp",
+                                            dir=os.path.dirname(os.path.abspath(indexPath)))
+            try:
+                with os.fdopen(fd, mode='w', encoding='utf-8') as f:
+                    f.write("%s\t%d\t%d\n" % (g_fai_magic, stat.st_size, stat.st_mtime_ns))
+                    for record in self.records.values():
+                        f.write("%s\t%d\t%d\t%d\t%d\n" % (record.name, record.length, record.offset,
+                                                          record.lineBases, record.lineBytes))
+                os.replace(tempPath, indexPath)
+            except BaseException:
+                os.unlink(tempPath)
+                raise
+        except OSError:
+            print("failed to write FASTA index", indexPath)
+
+    def Close(self):
+        if (self.data is not None):
+            self.data.close()
+            self.data = None
+        if (self.stream is not None):
+            self.stream.close()
+            self.stream = None
+
+    # raw bytes [start, end) of the uncompressed file.
+    def ReadBytes(self, start, end):
+        if (self.compressed):
+            if (self.stream is None):
+                self.stream = OpenBinary(self.filePath)
+            self.stream.seek(start)
+            return self.stream.read(end - start)
+
+        if (self.data is None):
+            with open(self.filePath, mode='rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.data[start:end]
+
+    def GetNames(self):
+        return list(self.records.keys())
+
+    def GetLength(self, name):
+        return self.records[name].length
+
+    # bases start..end (1-based, inclusive, as in GFF3) of a record.
+    def Fetch(self, name, start, end):
+        record = self.records[name]
+        start = max(1, start)
+        end = min(record.length, end)
+        if (end < start):
+            return ""
+
+        def ByteOffset(pos):
+            return record.offset + (pos // record.lineBases) * record.lineBytes + pos % record.lineBases
+
+        data = self.ReadBytes(ByteOffset(start - 1), ByteOffset(end - 1) + 1)
+        return data.replace(b"\n", b"").replace(b"\r", b"").decode('ascii')
+
+    # concatenation of the given (start, end) parts in transcript order,
+    # reverse-complemented on the - strand.
+    def GetSplicedSequence(self, name, parts, strand = "+"):
+        parts = sorted((int(start), int(end)) for start, end in parts)
+        sequence = "".join(self.Fetch(name, start, end) for start, end in parts)
+        if (strand == "-"):
+            sequence = sequence.encode('ascii').translate(g_complement)[::-1].decode('ascii')
+        return sequence
+
+    # spliced sequences of every RNA of a gene structure dict (as built by
+    # sjh_gff3_parser or GFF3Exporter), keyed by RNA name. type is "CDS" for
+    # coding sequences or "exon" for transcript sequences.
+    def GetStructureSequences(self, seqid, gene_structure, type = "CDS"):
+        sequences = {}
+        for rna_item in gene_structure.get('children', []):
+            parts = [(f['start'], f['end']) for f in rna_item['sub_feature'] if f['type'] == type]
+            if parts:
+                sequences[rna_item['name']] = self.GetSplicedSequence(seqid, parts, rna_item['strand'])
+        return sequences
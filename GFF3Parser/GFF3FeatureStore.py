@@ -0,0 +1,220 @@
+from array import array
+
+import numpy
+
+from GFF3Utils import GFF3Item
+
+# columnar, array-backed storage for parsed GFF3 features.
+# every feature is one row; coordinates are kept in int arrays, the repetitive
+# columns (seqid, source, type, strand, phase) as small int codes, and IDs,
+# parent IDs and the raw attribute column as indices into one shared StringPool.
+# the "parentID" column holds the first parent of a row; all parents are in the
+# child row -> parent code relation, one entry per (row, parent) pair, so a
+# feature with Parent=a,b is a child of both.
+# rows are never materialized as Python objects unless GetItem is called.
+
+
+# maps strings to dense int codes and back.
+class StringPool:
+
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+
+    def Intern(self, s):
+        code = self.codes.get(s)
+        if (code is None):
+            code = len(self.strings)
+            self.codes[s] = code
+            self.strings.append(s)
+        return code
+
+    # code of s, or -1 if s was never interned.
+    def Find(self, s):
+        return self.codes.get(s, -1)
+
+    def Get(self, code):
+        return self.strings[code] if code >= 0 else ""
+
+    def __len__(self):
+        return len(self.strings)
+
+
+
+class GFF3FeatureStore:
+
+    # column name -> array typecode used while filling.
+    g_columns = {
+        "seqid"  : "i",
+        "source" : "i",
+        "type"   : "i",
+        "start"  : "q",
+        "end"    : "q",
+        "score"  : "d",
+        "strand" : "b",
+        "phase"  : "b",
+        "ID"     : "q",
+        "parentID" : "q",
+        "info"   : "q",
+        }
+
+    # the child -> parent relation, array typecodes as above.
+    g_relations = {
+        "childRow"   : "q",
+        "parentCode" : "q",
+        }
+
+    # categorical columns, each with its own code table.
+    g_categorical = ("seqid", "source", "type", "strand", "phase")
+
+    def __init__(self):
+        self.Clear()
+
+    # drop all rows, in place, leaving an empty writable store.
+    def Clear(self):
+        self.pools = { name : StringPool() for name in GFF3FeatureStore.g_categorical }
+        self.strings = StringPool()
+        self.buffers = { name : array(code) for name, code in GFF3FeatureStore.g_columns.items() }
+        self.buffers.update((name, array(code)) for name, code in GFF3FeatureStore.g_relations.items())
+        self.columns = None
+        self.indexes = {}
+
+    def __len__(self):
+        if (self.buffers is None):
+            return len(self.columns["start"])
+        return len(self.buffers["start"])
+
+    # append one feature from the 9 split columns of a GFF3 line and the list
+    # of its parent IDs.
+    def AppendFields(self, strs, ID = "", parentIDs = ()):
+        pools = self.pools
+        buffers = self.buffers
+
+        buffers["seqid"].append(pools["seqid"].Intern(strs[0]))
+        buffers["source"].append(pools["source"].Intern(strs[1]))
+        buffers["type"].append(pools["type"].Intern(strs[2]))
+        buffers["start"].append(int(strs[3]))
+        buffers["end"].append(int(strs[4]))
+        buffers["score"].append(float("nan") if strs[5] == "." else float(strs[5]))
+        buffers["strand"].append(pools["strand"].Intern(strs[6]))
+        buffers["phase"].append(pools["phase"].Intern(strs[7]))
+        buffers["ID"].append(self.strings.Intern(ID) if ID else -1)
+        buffers["info"].append(self.strings.Intern(strs[8]))
+
+        row = len(buffers["start"]) - 1
+        parentCodes = [self.strings.Intern(parentID) for parentID in parentIDs]
+        buffers["parentID"].append(parentCodes[0] if parentCodes else -1)
+        for code in parentCodes:
+            buffers["childRow"].append(row)
+            buffers["parentCode"].append(code)
+
+        self.columns = None
+        self.indexes = {}
+
+    def AppendItem(self, item):
+        self.AppendFields(item.GetFields(), item.ID, item.parentIDs)
+
+    # numpy view of a column or relation array; rebuilt lazily after the store
+    # was appended to. stores loaded from a parse cache have no buffers and are read-only.
+    def GetColumn(self, name):
+        if (self.columns is None):
+            self.columns = { n : numpy.array(b) for n, b in self.buffers.items() }
+        return self.columns[name]
+
+    # (rows ordered by the string code of an "ID"/"parentID" column, their codes)
+    # for lookups by value; built lazily. for "parentCode" the "rows" are
+    # entries of the relation.
+    def GetSortedIndex(self, name):
+        index = self.indexes.get(name)
+        if (index is None):
+            column = self.GetColumn(name)
+            order = numpy.argsort(column, kind='stable')
+            index = (order, column[order])
+            self.indexes[name] = index
+        return index
+
+    def GetRowsByValue(self, name, value):
+        code = self.strings.Find(value)
+        if (code < 0):
+            return numpy.zeros(0, dtype=numpy.int64)
+        order, codes = self.GetSortedIndex(name)
+        lo = numpy.searchsorted(codes, code, side='left')
+        hi = numpy.searchsorted(codes, code, side='right')
+        return order[lo:hi]
+
+    def GetRowsByID(self, ID):
+        return self.GetRowsByValue("ID", ID)
+
+    # rows of all features listing parentID as a parent, in file order.
+    def GetChildRows(self, parentID):
+        return self.GetColumn("childRow")[self.GetRowsByValue("parentCode", parentID)]
+
+    def GetLengths(self):
+        return self.GetColumn("end") - self.GetColumn("start") + 1
+
+    # boolean mask of the rows whose categorical column equals any of values.
+    def GetMask(self, name, values):
+        if (isinstance(values, str)):
+            values = [values]
+        codes = [self.pools[name].Find(v) for v in values]
+        codes = [c for c in codes if c >= 0]
+        return numpy.isin(self.GetColumn(name), codes)
+
+    # row indices matching all of the given filters, e.g. all CDS on chr3
+    # longer than 300 bp:
+    #   store.Select(seqid = "chr3", type = "CDS", minLength = 301)
+    def Select(self, seqid = None, source = None, type = None, strand = None, phase = None,
+               minLength = None, maxLength = None, start = None, end = None):
+        mask = numpy.ones(len(self), dtype=bool)
+
+        for name, values in (("seqid", seqid), ("source", source), ("type", type),
+                             ("strand", strand), ("phase", phase)):
+            if (values is not None):
+                mask &= self.GetMask(name, values)
+
+        if (minLength is not None or maxLength is not None):
+            lengths = self.GetLengths()
+            if (minLength is not None):
+                mask &= lengths >= minLength
+            if (maxLength is not None):
+                mask &= lengths <= maxLength
+
+        # features overlapping [start, end]
+        if (start is not None):
+            mask &= self.GetColumn("end") >= start
+        if (end is not None):
+            mask &= self.GetColumn("start") <= end
+
+        return numpy.flatnonzero(mask)
+
+    def GetValue(self, name, row):
+        code = int(self.GetColumn(name)[row])
+        if (name in self.pools):
+            return self.pools[name].Get(code)
+        return self.strings.Get(code)
+
+    def GetID(self, row):
+        return self.GetValue("ID", row)
+
+    # first parent of a row.
+    def GetParentID(self, row):
+        return self.GetValue("parentID", row)
+
+    # the 9 GFF3 columns of a row, as strings.
+    def GetFields(self, row):
+        score = self.GetColumn("score")[row]
+        return [
+            self.GetValue("seqid", row),
+            self.GetValue("source", row),
+            self.GetValue("type", row),
+            str(self.GetColumn("start")[row]),
+            str(self.GetColumn("end")[row]),
+            "." if numpy.isnan(score) else "{:g}".format(score),
+            self.GetValue("strand", row),
+            self.GetValue("phase", row),
+            self.GetValue("info", row),
+            ]
+
+    # materialize one row as a GFF3Item.
+    def GetItem(self, row):
+        return GFF3Item(self.GetFields(row))
@@ -0,0 +1,117 @@
+import os
+import time
+
+from GFF3Compression import IsGzipFile
+from GFF3Parser import GFF3Parser, IsFastaStart
+from GFF3Utils import GFF3Item
+
+# tail-following parse of a GFF3 file that is being appended to.
+# the follower remembers the byte offset after the last complete line it has
+# parsed; every Refresh reads only what was appended since, adds the new items to
+# the parser's parentID -> GFF3Gene groups and, if given, appends them to a
+# GFF3FeatureStore and indexes them in a GFF3OffsetIndex, all in place; the index
+# never covers more of the file than the follower has parsed.
+# an unterminated last line is left for the next Refresh. if the file shrank or
+# was replaced, the parser, store and index are cleared (in place, so the
+# caller's objects stay valid) and the file is parsed again from the start; compressed
+# files cannot be appended to line by line and are re-parsed whenever they change.
+
+
+class GFF3Follower:
+
+    # store must be a writable GFF3FeatureStore (not one loaded from a parse cache).
+    def __init__(self, filePath, parser = None, store = None, index = None, typeFilter = None):
+        self.filePath = filePath
+        self.parser = GFF3Parser() if parser is None else parser
+        self.store = store
+        self.index = index
+        self.typeFilter = typeFilter
+
+        self.offset = 0
+        self.fileID = None
+        self.mtime = -1
+        self.fasta = False
+
+    def Reset(self):
+        self.parser.items.clear()
+        if (self.store is not None):
+            self.store.Clear()
+        if (self.index is not None):
+            self.index.Clear()
+
+        self.offset = 0
+        self.fasta = False
+
+    # parse what was appended since the last call; returns the new GFF3Items.
+    def Refresh(self):
+        stat = os.stat(self.filePath)
+        fileID = (stat.st_dev, stat.st_ino)
+
+        if (IsGzipFile(self.filePath)):
+            if (fileID == self.fileID and stat.st_mtime_ns == self.mtime):
+                return []
+            self.Reset()
+            self.fileID = fileID
+            self.mtime = stat.st_mtime_ns
+            if (self.index is not None):
+                self.index.Build()
+            with GFF3Parser.OpenFile(self.filePath) as fs:
+                return self.AddLines(fs)
+
+        if (fileID != self.fileID or stat.st_size < self.offset):
+            self.Reset()
+            self.fileID = fileID
+        self.mtime = stat.st_mtime_ns
+
+        items = self.ReadAppended(stat.st_size)
+
+        if (self.index is not None and not self.index.Update(self.offset)):
+            self.index.Build(False, self.offset)
+
+        return items
+
+    # parse the complete lines between self.offset and size.
+    def ReadAppended(self, size):
+        if (self.fasta or size == self.offset):
+            return []
+
+        with open(self.filePath, mode='rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+
+        # only complete lines; the rest may still be being written
+        end = data.rfind(b"\n") + 1
+        if (end == 0):
+            return []
+        self.offset += end
+
+        lines = data[:end].decode('utf-8').splitlines()
+        for i, line in enumerate(lines):
+            if (IsFastaStart(line)):
+                self.fasta = True
+                lines = lines[:i]
+                break
+
+        return self.AddLines(lines)
+
+    def AddLines(self, lines):
+        items = []
+        for strs in GFF3Parser.IterFields(lines, typeFilter = self.typeFilter):
+            item = GFF3Item(strs)
+            self.parser.AddItem(item)
+            if (self.store is not None):
+                self.store.AppendItem(item)
+            items.append(item)
+        return items
+
+    # refresh every `interval` seconds and yield the new items of each refresh
+    # that found any; stops after `count` refreshes if count is given.
+    def Follow(self, interval = 1.0, count = None):
+        refreshes = 0
+        while (count is None or refreshes < count):
+            items = self.Refresh()
+            refreshes += 1
+            if (items):
+                yield items
+            if (count is None or refreshes < count):
+                time.sleep(interval)
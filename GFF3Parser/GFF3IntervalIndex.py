@@ -0,0 +1,197 @@
+import numpy
+
+# per-seqid interval index over the rows of a GFF3FeatureStore.
+# for every seqid the rows are sorted by start and split into bins by length
+# class (lengths within a factor of g_length_bin_base of each other). a row of a
+# bin of maximum length maxLength can only overlap [qs, qe] if it starts in
+# [qs - maxLength + 1, qe], so a query is two binary searches per bin plus one
+# vectorized filter over those windows, and a few long features (chromosomes,
+# "region" lines) only widen the window of their own bin.
+# the bins are kept in one array of keys, bin index * stride + padded start, so
+# the windows of all bins are found with one searchsorted call per bound; the padding
+# keeps the lower bound of a bin's window from reaching into the bin before it.
+# coordinates are 1-based and closed, as in GFF3.
+
+g_length_bin_base = 4
+
+
+# (window index, position) of every position of the windows [lo, hi), window
+# by window.
+def ExpandWindows(lo, hi):
+    counts = numpy.maximum(hi - lo, 0)
+    total = int(counts.sum())
+    windows = numpy.repeat(numpy.arange(len(lo)), counts)
+    positions = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts) + numpy.repeat(lo, counts)
+    return windows, positions
+
+
+class SeqidIntervals:
+
+    def __init__(self, rows, starts, ends):
+        order = numpy.lexsort((ends, starts))
+        self.rows = rows[order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+
+        # length classes: floor(log_base(length)); empty or reversed features
+        # count as length 1
+        lengths = numpy.maximum(self.ends - self.starts + 1, 1)
+        classes = numpy.floor(numpy.log(lengths) / numpy.log(g_length_bin_base)).astype(numpy.int64)
+        binOrder = numpy.argsort(classes, kind='stable')
+        binIDs, binStarts = numpy.unique(classes[binOrder], return_index=True)
+
+        self.binMaxLengths = numpy.maximum.reduceat(lengths[binOrder], binStarts) if len(order) else lengths
+        self.minStart = int(self.starts.min()) if len(order) else 0
+        self.maxStart = int(self.starts.max()) if len(order) else 0
+        pad = int(self.binMaxLengths.max()) if len(order) else 0
+        stride = pad + self.maxStart - self.minStart + 2
+        binBases = numpy.arange(len(binIDs), dtype=numpy.int64) * stride + pad - self.minStart
+        binIdx = numpy.repeat(numpy.arange(len(binIDs)), numpy.diff(numpy.r_[binStarts, len(order)]))
+
+        # positions into the start-sorted arrays above, bin by bin, and their keys
+        self.binPositions = binOrder
+        self.binKeys = binBases[binIdx] + self.starts[binOrder]
+        self.lowKeys = binBases - self.binMaxLengths + 1
+        self.highKeys = binBases
+
+        # rows ordered by end, for upstream nearest-feature lookups
+        endOrder = numpy.argsort(ends, kind='stable')
+        self.rowsByEnd = rows[endOrder]
+        self.sortedEnds = ends[endOrder]
+
+    # windows [lo, hi) into binPositions of the rows that start in
+    # [low - maxLength + 1, high] of every bin (or a superset, for a low past
+    # the last start). low and high may be arrays, the windows then have one row
+    # per query and one column per bin.
+    def GetWindows(self, low, high):
+        if (not isinstance(low, numpy.ndarray)):
+            low = min(max(low, self.minStart), self.maxStart)
+            high = min(max(high, self.minStart - 1), self.maxStart)
+        else:
+            low = numpy.clip(low, self.minStart, self.maxStart)[:, None]
+            high = numpy.clip(high, self.minStart - 1, self.maxStart)[:, None]
+        lo = numpy.searchsorted(self.binKeys, self.lowKeys + low, side='left')
+        hi = numpy.searchsorted(self.binKeys, self.highKeys + high, side='right')
+        return lo, hi
+
+    # start-sorted positions of the rows in the windows of a single query, in
+    # start order.
+    def GetCandidates(self, low, high):
+        lo, hi = self.GetWindows(low, high)
+        found = [self.binPositions[l:h] for l, h in zip(lo.tolist(), hi.tolist()) if h > l]
+        if (len(found) == 1):
+            return found[0]
+        if (not found):
+            return self.binPositions[:0]
+        return numpy.sort(numpy.concatenate(found))
+
+    def Overlapping(self, qs, qe):
+        candidates = self.GetCandidates(qs, qe)
+        return self.rows[candidates[self.ends[candidates] >= qs]]
+
+    def Contained(self, qs, qe):
+        lo = numpy.searchsorted(self.starts, qs, side='left')
+        hi = numpy.searchsorted(self.starts, qe, side='right')
+        mask = self.ends[lo:hi] <= qe
+        return self.rows[lo:hi][mask]
+
+    def Containing(self, qs, qe):
+        candidates = self.GetCandidates(qe, qs)
+        return self.rows[candidates[self.ends[candidates] >= qe]]
+
+    # rows closest to [qs, qe]; overlapping rows have distance 0.
+    # returns (rows, distance), rows tied at the same distance are all returned.
+    def Nearest(self, qs, qe):
+        overlapping = self.Overlapping(qs, qe)
+        if (len(overlapping)):
+            return overlapping, 0
+
+        # upstream: largest end < qs; downstream: smallest start > qe
+        i = numpy.searchsorted(self.sortedEnds, qs, side='left')
+        j = numpy.searchsorted(self.starts, qe, side='right')
+        up = qs - self.sortedEnds[i - 1] if i > 0 else None
+        down = self.starts[j] - qe if j < len(self.starts) else None
+
+        if (up is None and down is None):
+            return self.rows[:0], -1
+
+        distance = min(d for d in (up, down) if d is not None)
+        found = []
+        if (up == distance):
+            found.append(self.rowsByEnd[numpy.searchsorted(self.sortedEnds, self.sortedEnds[i - 1], side='left'):i])
+        if (down == distance):
+            found.append(self.rows[j:numpy.searchsorted(self.starts, self.starts[j], side='right')])
+        return numpy.concatenate(found), int(distance)
+
+    # vectorized overlap of many queries at once.
+    # returns (query indices, rows) of all overlapping pairs, by query and start.
+    def OverlappingMany(self, qstarts, qends):
+        qstarts = numpy.asarray(qstarts)
+        qends = numpy.asarray(qends)
+        lo, hi = self.GetWindows(qstarts, qends)
+
+        windows, positions = ExpandWindows(lo.ravel(), hi.ravel())
+        queries = windows // max(1, len(self.highKeys))
+        positions = self.binPositions[positions]
+
+        mask = self.ends[positions] >= qstarts[queries]
+        queries = queries[mask]
+        positions = positions[mask]
+        order = numpy.lexsort((positions, queries))
+        return queries[order], self.rows[positions[order]]
+
+
+
+class GFF3IntervalIndex:
+
+    # rows: optional subset of store rows to index, e.g. store.Select(type = "gene")
+    def __init__(self, store, rows = None):
+        self.store = store
+        self.seqids = {}
+
+        if (rows is None):
+            rows = numpy.arange(len(store))
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+
+        seqidCodes = store.GetColumn("seqid")[rows]
+        starts = store.GetColumn("start")[rows]
+        ends = store.GetColumn("end")[rows]
+
+        for code in numpy.unique(seqidCodes):
+            mask = seqidCodes == code
+            seqid = store.pools["seqid"].Get(int(code))
+            self.seqids[seqid] = SeqidIntervals(rows[mask], starts[mask], ends[mask])
+
+    def GetSeqids(self):
+        return list(self.seqids.keys())
+
+    def Overlapping(self, seqid, start, end):
+        intervals = self.seqids.get(seqid)
+        if (intervals is None):
+            return numpy.zeros(0, dtype=numpy.int64)
+        return intervals.Overlapping(start, end)
+
+    def Contained(self, seqid, start, end):
+        intervals = self.seqids.get(seqid)
+        if (intervals is None):
+            return numpy.zeros(0, dtype=numpy.int64)
+        return intervals.Contained(start, end)
+
+    def Containing(self, seqid, start, end):
+        intervals = self.seqids.get(seqid)
+        if (intervals is None):
+            return numpy.zeros(0, dtype=numpy.int64)
+        return intervals.Containing(start, end)
+
+    def Nearest(self, seqid, start, end = None):
+        intervals = self.seqids.get(seqid)
+        if (intervals is None):
+            return numpy.zeros(0, dtype=numpy.int64), -1
+        return intervals.Nearest(start, start if end is None else end)
+
+    def OverlappingMany(self, seqid, starts, ends):
+        intervals = self.seqids.get(seqid)
+        if (intervals is None):
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return empty, empty
+        return intervals.OverlappingMany(starts, ends)
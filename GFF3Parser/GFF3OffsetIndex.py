@@ -0,0 +1,248 @@
+import itertools
+import os
+import struct
+
+import numpy
+
+from GFF3Utils import GFF3Attributes
+from GFF3Compression import IsGzipFile, IsBGZFFile, GetBGZFBlocks, OpenBinary
+from GFF3IntervalIndex import SeqidIntervals
+from GFF3ParseCache import WriteArrayFile, ReadArrayFileHeader, MapArray
+
+# sidecar index of a GFF3 file: maps ID and Parent values, and per-seqid feature
+# coordinates, to the byte offsets of the lines carrying them, so a lookup only
+# seeks to and reads those lines.
+# offsets are into the uncompressed text; for BGZF input the block offset index
+# is stored as well, so a lookup only decompresses the blocks it touches.
+# the index is written next to the source as <file>.idx, in the layout of the
+# parse cache (a JSON header followed by raw arrays, see GFF3ParseCache), and
+# rebuilt whenever the size or mtime of the source no longer match the ones
+# recorded in it, or it cannot be read. lines appended to a plain text source can
+# be indexed in place with Update.
+
+g_index_suffix = ".idx"
+g_index_magic = b"GFF3INDEX"
+g_index_version = 5
+
+
+class GFF3OffsetIndex:
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.Clear()
+
+    # forget everything indexed, in place; the next Update indexes the source
+    # from its start.
+    def Clear(self):
+        self.size = -1
+        self.mtime = -1
+        self.end = 0
+        self.fasta = False
+        self.ids = {}
+        self.parents = {}
+        self.regions = {}
+        self.blocks = None
+        self.intervals = {}
+
+    @staticmethod
+    def GetIndexPath(filePath):
+        return filePath + g_index_suffix
+
+    # load the sidecar index of filePath, (re)building it if missing or stale.
+    @staticmethod
+    def Load(filePath, save = True):
+        index = GFF3OffsetIndex(filePath)
+        if (index.ReadIndex()):
+            return index
+
+        index.Build()
+        if (save):
+            index.WriteIndex()
+        return index
+
+    def IsUpToDate(self):
+        stat = os.stat(self.filePath)
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime
+
+    # (re)index the whole source in place. with final False an unterminated last
+    # line is left out, and with limit set only the lines before that byte
+    # offset are indexed, as for a source that is still being written.
+    def Build(self, final = True, limit = None):
+        self.Clear()
+        stat = os.stat(self.filePath)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.blocks = GetBGZFBlocks(self.filePath) if IsBGZFFile(self.filePath) else None
+
+        with self.Open() as f:
+            self.IndexLines(f, 0, final, limit)
+
+    # index the lines appended to a plain text source since the last Build or
+    # Update, in place; with limit set, only those before that byte offset.
+    # returns False if the source is compressed or was rewritten, which needs a
+    # full Build instead.
+    def Update(self, limit = None):
+        stat = os.stat(self.filePath)
+        if (self.blocks is not None or IsGzipFile(self.filePath) or stat.st_size < self.end):
+            return False
+
+        end = stat.st_size if limit is None else min(limit, stat.st_size)
+        if (not self.fasta and end > self.end):
+            with open(self.filePath, mode='rb') as f:
+                f.seek(self.end)
+                self.IndexLines(f, self.end, False, limit)
+            self.intervals = {}
+
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        return True
+
+    # index the lines of f, which is positioned at offset. an unterminated last
+    # line is only indexed if final is True; otherwise it is left for the next
+    # Update, as it may still be being written. lines reaching past limit, if
+    # given, are not indexed either.
+    def IndexLines(self, f, offset, final, limit = None):
+        regions = {}
+        for line in f:
+            if (not final and not line.endswith(b"\n")):
+                break
+            if (limit is not None and offset + len(line) > limit):
+                break
+
+            lineOffset = offset
+            offset += len(line)
+            self.end = offset
+
+            if (line.startswith(b"#")):
+                if (line.startswith(b"##FASTA")):
+                    self.fasta = True
+                    break
+                continue
+
+            strs = line.rstrip(b"\r\n").split(b"\t")
+            if (len(strs) < 9):
+                continue
+
+            attributes = GFF3Attributes(strs[8].decode('utf-8'))
+            ID = attributes.GetID()
+            if (ID):
+                self.ids.setdefault(ID, []).append(lineOffset)
+            for parentID in (attributes.GetParentIDs() or [""]):
+                self.parents.setdefault(parentID, []).append(lineOffset)
+
+            region = regions.setdefault(strs[0].decode('utf-8'), ([], [], []))
+            region[0].append(int(strs[3]))
+            region[1].append(int(strs[4]))
+            region[2].append(lineOffset)
+
+        for seqid, region in regions.items():
+            columns = tuple(numpy.array(c, dtype=numpy.int64) for c in region)
+            if (seqid in self.regions):
+                columns = tuple(numpy.concatenate(c) for c in zip(self.regions[seqid], columns))
+            self.regions[seqid] = columns
+
+    # load the sidecar index; False if it is missing, cannot be read, whatever
+    # the reason, or is stale.
+    def ReadIndex(self):
+        indexPath = GFF3OffsetIndex.GetIndexPath(self.filePath)
+        if (not os.path.isfile(indexPath)):
+            return False
+
+        try:
+            header, dataStart = ReadArrayFileHeader(indexPath, g_index_magic, g_index_version)
+            if (header is None):
+                return False
+
+            def Read(name):
+                return numpy.array(MapArray(indexPath, header, dataStart, name))
+
+            ids = ReadOffsetLists(header["ids"], Read("ids.counts"), Read("ids.offsets"))
+            parents = ReadOffsetLists(header["parents"], Read("parents.counts"), Read("parents.offsets"))
+            regions = { seqid : tuple(Read("region.%d.%s" % (i, name)) for name in ("start", "end", "offset"))
+                        for i, seqid in enumerate(header["regions"]) }
+            blocks = None
+            if (header["blocks"] is not None):
+                blocks = (Read("blocks.coffsets").tolist(), Read("blocks.uoffsets").tolist(), header["blocks"])
+            size, mtime, end, fasta = header["size"], header["mtime"], header["end"], header["fasta"]
+        except (OSError, ValueError, KeyError, TypeError, IndexError, struct.error):
+            return False
+
+        self.size = size
+        self.mtime = mtime
+        self.end = end
+        self.fasta = fasta
+        self.ids = ids
+        self.parents = parents
+        self.regions = regions
+        self.blocks = blocks
+        self.intervals = {}
+        return self.IsUpToDate()
+
+    def WriteIndex(self):
+        header = {
+            "size" : self.size,
+            "mtime" : self.mtime,
+            "end" : self.end,
+            "fasta" : self.fasta,
+            "ids" : list(self.ids.keys()),
+            "parents" : list(self.parents.keys()),
+            "regions" : list(self.regions.keys()),
+            "blocks" : None if self.blocks is None else self.blocks[2],
+            }
+
+        arrays = {}
+        for name, lists in (("ids", self.ids), ("parents", self.parents)):
+            arrays[name + ".counts"] = numpy.array([len(offsets) for offsets in lists.values()], dtype=numpy.int64)
+            arrays[name + ".offsets"] = numpy.fromiter(itertools.chain.from_iterable(lists.values()), dtype=numpy.int64)
+        for i, region in enumerate(self.regions.values()):
+            for name, column in zip(("start", "end", "offset"), region):
+                arrays["region.%d.%s" % (i, name)] = column
+        if (self.blocks is not None):
+            arrays["blocks.coffsets"] = numpy.array(self.blocks[0], dtype=numpy.int64)
+            arrays["blocks.uoffsets"] = numpy.array(self.blocks[1], dtype=numpy.int64)
+
+        indexPath = GFF3OffsetIndex.GetIndexPath(self.filePath)
+        try:
+            WriteArrayFile(indexPath, g_index_magic, g_index_version, header, arrays)
+        except OSError:
+            print("failed to write index", indexPath)
+
+    # seekable binary stream over the uncompressed lines of the source.
+    def Open(self):
+        return OpenBinary(self.filePath, self.blocks)
+
+    def GetOffsetsByID(self, ID):
+        return self.ids.get(ID, [])
+
+    def GetOffsetsByParent(self, parentID):
+        return self.parents.get(parentID, [])
+
+    # offsets of the lines overlapping seqid:[start, end], in file order.
+    def GetOffsetsByRegion(self, seqid, start, end):
+        intervals = self.intervals.get(seqid)
+        if (intervals is None):
+            region = self.regions.get(seqid)
+            if (region is None):
+                return []
+            intervals = SeqidIntervals(region[2], region[0], region[1])
+            self.intervals[seqid] = intervals
+
+        return numpy.sort(intervals.Overlapping(start, end)).tolist()
+
+    # split columns of the lines at the given offsets of an opened file.
+    @staticmethod
+    def ReadFields(f, offsets):
+        fields = []
+        for offset in offsets:
+            f.seek(offset)
+            fields.append(f.readline().decode('utf-8').strip().split("\t"))
+        return fields
+
+
+# key -> list of offsets, from the keys, the number of offsets of each key and
+# all offsets in key order.
+def ReadOffsetLists(keys, counts, offsets):
+    if (len(keys) != len(counts) or counts.sum() != len(offsets)):
+        raise ValueError("inconsistent offset lists")
+    values = iter(offsets.tolist())
+    return { key : list(itertools.islice(values, count)) for key, count in zip(keys, counts.tolist()) }
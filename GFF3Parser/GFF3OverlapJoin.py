@@ -0,0 +1,160 @@
+import numpy
+
+from GFF3IntervalIndex import GFF3IntervalIndex, ExpandWindows
+
+# overlap join of the features of two GFF3FeatureStores, e.g. two versions of
+# an annotation. both sides are sorted by seqid and start; the left features
+# are then swept in start order against the right features of the same seqid.
+# the right features are binned by length class (see SeqidIntervals), and the
+# candidate window of a left feature in each bin is bounded by the longest
+# feature of that bin, so a chromosome or "region" line only widens the window
+# of its own bin, not the whole sweep; the candidates are filtered with
+# vectorized masks.
+# the sweep advances over the left side in batches of at most g_join_batch
+# candidate pairs, and the overlapping pairs of every batch are yielded before
+# the next one is expanded, so memory stays bounded by the batch size whatever
+# the size of the output.
+
+g_join_batch = 1 << 20
+
+
+# (seqid, rows in start order) for every seqid of a store, sorted by seqid.
+# rows: optional subset of store rows.
+def GetSortedRows(store, rows = None):
+    if (rows is None):
+        rows = numpy.arange(len(store))
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    if (len(rows) == 0):
+        return []
+
+    seqidCodes = store.GetColumn("seqid")[rows]
+    order = numpy.lexsort((store.GetColumn("end")[rows], store.GetColumn("start")[rows], seqidCodes))
+    rows = rows[order]
+    seqidCodes = seqidCodes[order]
+
+    groupStarts = numpy.flatnonzero(numpy.r_[True, seqidCodes[1:] != seqidCodes[:-1]])
+    bounds = numpy.r_[groupStarts, len(rows)]
+    seqids = [(store.pools["seqid"].Get(int(seqidCodes[s])), rows[s:e]) for s, e in zip(bounds[:-1], bounds[1:])]
+    return sorted(seqids, key=lambda s: s[0])
+
+
+# split the candidate windows [lo, hi) of consecutive left features, one column
+# per bin, into runs of at most batchSize pairs; yields (left positions,
+# positions into the bins of the right side).
+def IterCandidates(lo, hi, batchSize):
+    bins = lo.shape[1]
+    counts = numpy.maximum(hi - lo, 0).sum(axis=1)
+    offsets = numpy.r_[0, numpy.cumsum(counts)]
+
+    i = 0
+    while (i < len(counts)):
+        j = max(i + 1, int(numpy.searchsorted(offsets, offsets[i] + batchSize, side='right')) - 1)
+
+        # the windows of a single feature with more candidates than the batch
+        # are split on their own
+        if (counts[i] > batchSize):
+            for b in range(bins):
+                for start in range(int(lo[i, b]), int(hi[i, b]), batchSize):
+                    positions = numpy.arange(start, min(start + batchSize, int(hi[i, b])))
+                    yield numpy.full(len(positions), i), positions
+            i += 1
+            continue
+
+        if (offsets[j] > offsets[i]):
+            windows, positions = ExpandWindows(lo[i:j].ravel(), hi[i:j].ravel())
+            yield i + windows // bins, positions
+        i = j
+
+
+# yield (left rows, right rows, overlap lengths) batches of all overlapping pairs,
+# ordered by seqid and left start.
+#   leftRows/rightRows: optional row subsets, e.g. store.Select(type = "exon")
+#   leftTypes/rightTypes: types to keep on each side (shorthand for the above)
+#   strand: None to ignore strands, "same" or "opposite"
+#   minFraction: minimum overlap as a fraction of the left feature's length, or
+#     of both features' lengths if reciprocal is True
+def IterOverlaps(left, right, leftRows = None, rightRows = None, leftTypes = None, rightTypes = None,
+                 strand = None, minFraction = 0.0, reciprocal = False, batchSize = g_join_batch):
+    if (leftTypes is not None):
+        leftRows = numpy.intersect1d(left.Select(type = leftTypes), numpy.arange(len(left)) if leftRows is None else leftRows)
+    if (rightTypes is not None):
+        rightRows = numpy.intersect1d(right.Select(type = rightTypes), numpy.arange(len(right)) if rightRows is None else rightRows)
+
+    index = GFF3IntervalIndex(right, rightRows)
+
+    leftStarts = left.GetColumn("start")
+    leftEnds = left.GetColumn("end")
+    rightStarts = right.GetColumn("start")
+    rightEnds = right.GetColumn("end")
+
+    if (strand is not None):
+        # right store strand code wanted for each left store strand code
+        counterparts = { "+" : "-", "-" : "+" }
+        wanted = [counterparts.get(s, "") if strand == "opposite" else s for s in left.pools["strand"].strings]
+        strandMap = numpy.array([right.pools["strand"].Find(s) for s in wanted] + [-1])
+        leftStrands = left.GetColumn("strand")
+        rightStrands = right.GetColumn("strand")
+
+    for seqid, rows in GetSortedRows(left, leftRows):
+        intervals = index.seqids.get(seqid)
+        if (intervals is None):
+            continue
+
+        qstarts = leftStarts[rows]
+        qends = leftEnds[rows]
+        lo, hi = intervals.GetWindows(qstarts, qends)
+
+        for queries, positions in IterCandidates(lo, hi, batchSize):
+            # back to start order on the right side, within each left feature
+            positions = intervals.binPositions[positions]
+            order = numpy.lexsort((positions, queries))
+            queries = queries[order]
+            lrows = rows[queries]
+            rrows = intervals.rows[positions[order]]
+
+            overlaps = numpy.minimum(qends[queries], rightEnds[rrows]) - numpy.maximum(qstarts[queries], rightStarts[rrows]) + 1
+            mask = overlaps > 0
+            if (strand is not None):
+                mask &= strandMap[leftStrands[lrows]] == rightStrands[rrows]
+            if (minFraction > 0):
+                mask &= overlaps >= minFraction * (qends[queries] - qstarts[queries] + 1)
+                if (reciprocal):
+                    mask &= overlaps >= minFraction * (rightEnds[rrows] - rightStarts[rrows] + 1)
+
+            if (mask.any()):
+                yield lrows[mask], rrows[mask], overlaps[mask]
+
+
+# same pairs one at a time, as (left row, right row, overlap length).
+def IterOverlapPairs(left, right, **kwargs):
+    for lrows, rrows, overlaps in IterOverlaps(left, right, **kwargs):
+        yield from zip(lrows.tolist(), rrows.tolist(), overlaps.tolist())
+
+
+# string values of a column at the given rows.
+def GetColumnStrings(store, name, rows):
+    values = store.GetColumn(name)[rows].tolist()
+    if (name in store.pools):
+        pool = store.pools[name]
+    elif (name in ("ID", "parentID", "info")):
+        pool = store.strings
+    else:
+        return [str(v) for v in values]
+    return [pool.Get(v) for v in values]
+
+
+# write the pairs as tab-separated lines: seqid, left ID, left type, left start,
+# left end, right ID, right type, right start, right end, overlap length.
+# returns the number of pairs written.
+def WriteOverlaps(left, right, out, **kwargs):
+    count = 0
+    for lrows, rrows, overlaps in IterOverlaps(left, right, **kwargs):
+        columns = [GetColumnStrings(left, "seqid", lrows)]
+        columns += [GetColumnStrings(left, name, lrows) for name in ("ID", "type", "start", "end")]
+        columns += [GetColumnStrings(right, name, rrows) for name in ("ID", "type", "start", "end")]
+        columns.append([str(v) for v in overlaps.tolist()])
+
+        out.write("\n".join("\t".join(line) for line in zip(*columns)))
+        out.write("\n")
+        count += len(lrows)
+    return count
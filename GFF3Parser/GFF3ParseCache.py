@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import numpy
+
+from GFF3FeatureStore import GFF3FeatureStore, StringPool
+
+# binary parse cache of a GFF3FeatureStore, written next to the source as
+# <file>.cache. the file is a small JSON header followed by 64-byte aligned raw
+# arrays: the feature columns, the child -> parent relation, the ID and parent
+# lookup indexes and the shared
+# string pool (one utf-8 blob plus offsets). loading memory-maps the arrays, so
+# nothing is parsed or copied until it is used.
+# the cache is valid while the source has the same size and either the same
+# mtime or, if only the mtime changed, the same sha1 checksum.
+# it holds the store only, with its ID and parent lookups (the parent -> child
+# grouping of GFF3FeatureStore.GetChildRows, every parent of a feature
+# included); the GFF3Gene groups of GFF3Parser are not cached.
+# caches are replaced atomically, and one that is truncated, has a bad header or
+# cannot be mapped is ignored and rewritten.
+
+g_cache_suffix = ".cache"
+g_cache_magic = b"GFF3CACHE"
+g_cache_version = 3
+g_cache_align = 64
+
+g_cached_columns = list(GFF3FeatureStore.g_columns) + list(GFF3FeatureStore.g_relations)
+g_cached_indexes = ("ID", "parentCode")
+
+
+# string pool backed by a memory-mapped utf-8 blob.
+# Find binary-searches the codes sorted by string, so no dict is built on load.
+class MappedStringPool:
+
+    def __init__(self, blob, offsets, sortedCodes):
+        self.blob = blob
+        self.offsets = offsets
+        self.sortedCodes = sortedCodes
+
+    def Get(self, code):
+        if (code < 0):
+            return ""
+        return bytes(self.blob[self.offsets[code]:self.offsets[code + 1]]).decode('utf-8')
+
+    def Find(self, s):
+        lo = 0
+        hi = len(self.sortedCodes)
+        while (lo < hi):
+            mid = (lo + hi) // 2
+            value = self.Get(int(self.sortedCodes[mid]))
+            if (value < s):
+                lo = mid + 1
+            elif (value > s):
+                hi = mid
+            else:
+                return int(self.sortedCodes[mid])
+        return -1
+
+    def Intern(self, s):
+        raise TypeError("a cached string pool is read-only")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def GetCachePath(filePath):
+    return filePath + g_cache_suffix
+
+
+def GetFileChecksum(filePath):
+    digest = hashlib.sha1()
+    with open(filePath, mode='rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# write header and arrays to path in the layout described above: the magic, the
+# version and the header size, the JSON header, then the arrays, each aligned to
+# g_cache_align. the header gets "arrays" (name -> [dtype, offset, length]) and
+# "length", the size of the whole file. the file is written under a temporary
+# name in the same directory and renamed into place, so a reader sees either
+# the previous file or the complete new one.
+def WriteArrayFile(path, magic, version, header, arrays):
+    header["arrays"] = {}
+    layout = []
+    offset = 0
+    for name, values in arrays.items():
+        values = numpy.ascontiguousarray(values)
+        layout.append((name, values, offset))
+        header["arrays"][name] = [values.dtype.str, offset, len(values)]
+        offset = Align(offset + values.nbytes)
+
+    # the length depends on the header size, which depends on the length
+    header["length"] = 0
+    while (True):
+        headerBytes = json.dumps(header).encode('utf-8')
+        dataStart = Align(len(magic) + 12 + len(headerBytes))
+        if (header["length"] == dataStart + offset):
+            break
+        header["length"] = dataStart + offset
+
+    fd, tempPath = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, mode='wb') as f:
+            f.write(magic + struct.pack("<IQ", version, len(headerBytes)) + headerBytes)
+            for name, values, arrayOffset in layout:
+                f.seek(dataStart + arrayOffset)
+                f.write(values.tobytes())
+            f.truncate(header["length"])
+        os.replace(tempPath, path)
+    except BaseException:
+        os.unlink(tempPath)
+        raise
+
+
+def Align(offset):
+    return (offset + g_cache_align - 1) // g_cache_align * g_cache_align
+
+
+# (header, dataStart) of a file written by WriteArrayFile, or (None, 0) if it
+# has another magic or version or is not complete.
+def ReadArrayFileHeader(path, magic, version):
+    with open(path, mode='rb') as f:
+        if (f.read(len(magic)) != magic):
+            return None, 0
+        fileVersion, headerSize = struct.unpack("<IQ", f.read(12))
+        size = os.fstat(f.fileno()).st_size
+        if (fileVersion != version or headerSize > size):
+            return None, 0
+        header = json.loads(f.read(headerSize).decode('utf-8'))
+        dataStart = Align(f.tell())
+        if (header["length"] != size):
+            return None, 0
+    return header, dataStart
+
+
+# rewrite the header of a file written by WriteArrayFile in place, without
+# moving the arrays. returns False if the new header does not fit before them.
+def UpdateArrayFileHeader(path, magic, version, header, dataStart):
+    headerBytes = json.dumps(header).encode('utf-8')
+    space = dataStart - len(magic) - 12
+    if (len(headerBytes) > space):
+        return False
+    # padded to the old size, so the arrays stay where they are
+    headerBytes += b" " * (space - len(headerBytes))
+    with open(path, mode='r+b') as f:
+        f.write(magic + struct.pack("<IQ", version, len(headerBytes)) + headerBytes)
+    return True
+
+
+# memory-mapped array name of a file written by WriteArrayFile.
+def MapArray(path, header, dataStart, name):
+    dtype, offset, length = header["arrays"][name]
+    if (length == 0):
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r', offset=dataStart + offset, shape=(length,))
+
+
+def WriteCache(store, filePath):
+    stat = os.stat(filePath)
+
+    strings = store.strings.strings
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+    arrays = { "column." + name : store.GetColumn(name) for name in g_cached_columns }
+    for name in g_cached_indexes:
+        order, codes = store.GetSortedIndex(name)
+        arrays["index." + name + ".order"] = order
+        arrays["index." + name + ".codes"] = codes
+    arrays["strings.blob"] = numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)
+    arrays["strings.offsets"] = offsets
+    arrays["strings.sorted"] = numpy.array(sorted(range(len(strings)), key=strings.__getitem__), dtype=numpy.int64)
+
+    header = {
+        "source" : {
+            "size" : stat.st_size,
+            "mtime" : stat.st_mtime_ns,
+            "sha1" : GetFileChecksum(filePath),
+            },
+        "pools" : { name : pool.strings for name, pool in store.pools.items() },
+        }
+
+    cachePath = GetCachePath(filePath)
+    try:
+        WriteArrayFile(cachePath, g_cache_magic, g_cache_version, header, arrays)
+    except OSError:
+        print("failed to write parse cache", cachePath)
+
+
+# True if the cache of header still describes filePath. if only the mtime of
+# the source changed and its checksum did not, the new mtime is written to the
+# cache header, so the next load does not read the whole source again.
+def IsCacheValid(header, dataStart, filePath):
+    source = header["source"]
+    stat = os.stat(filePath)
+    if (stat.st_size != source["size"]):
+        return False
+    if (stat.st_mtime_ns == source["mtime"]):
+        return True
+    if (GetFileChecksum(filePath) != source["sha1"]):
+        return False
+
+    source["mtime"] = stat.st_mtime_ns
+    try:
+        UpdateArrayFileHeader(GetCachePath(filePath), g_cache_magic, g_cache_version, header, dataStart)
+    except OSError:
+        pass
+    return True
+
+
+# memory-mapped, read-only GFF3FeatureStore of filePath, or None if there is no
+# valid cache. a cache that cannot be read or mapped, whatever the reason, is
+# treated as missing.
+def ReadCache(filePath):
+    cachePath = GetCachePath(filePath)
+    if (not os.path.isfile(cachePath)):
+        return None
+
+    try:
+        header, dataStart = ReadArrayFileHeader(cachePath, g_cache_magic, g_cache_version)
+        if (header is None or not IsCacheValid(header, dataStart, filePath)):
+            return None
+
+        def Map(name):
+            return MapArray(cachePath, header, dataStart, name)
+
+        store = GFF3FeatureStore()
+        store.buffers = None
+        store.columns = { name : Map("column." + name) for name in g_cached_columns }
+        store.indexes = { name : (Map("index." + name + ".order"), Map("index." + name + ".codes"))
+                          for name in g_cached_indexes }
+
+        for name, strings in header["pools"].items():
+            pool = StringPool()
+            for s in strings:
+                pool.Intern(s)
+            store.pools[name] = pool
+
+        store.strings = MappedStringPool(Map("strings.blob"), Map("strings.offsets"), Map("strings.sorted"))
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        return None
+    return store
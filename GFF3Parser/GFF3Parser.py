@@ -1,44 +1,356 @@
 from GFF3ParserGlobalDefs import *
 from GFF3Utils import *
+from GFF3FeatureStore import *
+from GFF3Compression import *
+from GFF3ParseCache import *
+
+import itertools
+import os
+from multiprocessing import Pool
 
 def IsComment(line):
     return line.lstrip().startswith("##")
 
+# "###" directive: all forward references of the features above are resolved.
+def IsBlockEnd(line):
+    return line.lstrip().startswith("###")
+
+# "##FASTA" directive: the rest of the file is FASTA sequences, not features.
+def IsFastaStart(line):
+    return line.startswith("##FASTA")
+
+# worker of GFF3Parser.GetLineOfFileParallel: parse the newline-aligned byte
+# range [start, end) of a file into columns, one list per GFF3Item state field
+# (see GFF3Item.__getstate__), so no per-item object is pickled back. the
+# repetitive columns are interned, so each distinct value is pickled only once
+# per chunk. a parentIDs entry is a plain string ("" for none) unless the
+# feature has several parents: a list per row makes unpickling the chunk in the
+# parent several times slower. the rows are also grouped here, as
+# GFF3Parser.AddItem does: returns (columns, parentID -> list of rows).
+def ParseFileChunk(args):
+    filePath, start, end, typeFilter = args
+    with open(filePath, mode='rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    columns = tuple([] for i in range(11))
+    (marks, names, types, startIdxs, endIdxs, attr1s, attr2s, attr3s, infos, IDs, parentIDs) = columns
+    groups = {}
+    for row, strs in enumerate(GFF3Parser.IterFields(data.decode('utf-8').splitlines(), typeFilter = typeFilter)):
+        attributes = GFF3Attributes(strs[8])
+        marks.append(intern(strs[0]))
+        names.append(intern(strs[1]))
+        types.append(intern(strs[2]))
+        startIdxs.append(strs[3])
+        endIdxs.append(strs[4])
+        attr1s.append(strs[5])
+        attr2s.append(intern(strs[6]))
+        attr3s.append(intern(strs[7]))
+        infos.append(strs[8])
+        IDs.append(attributes.GetID())
+        rowParentIDs = attributes.GetParentIDs()
+        parentIDs.append(rowParentIDs if len(rowParentIDs) > 1 else rowParentIDs[0] if rowParentIDs else "")
+        for parentID in (rowParentIDs or [""]):
+            groups.setdefault(parentID, []).append(row)
+    return columns, groups
+
 
 
 class GFF3Parser:
-    
+
     def __init__(self):
         self.items = {}
 
     @staticmethod
     def OpenFile(filePath):
-        return open(filePath, mode='r', encoding='utf-8')
+        return OpenText(filePath)
 
-    def GetLineOfFileStream(self, fs):
-        for i, line in enumerate(fs):
+    # builds the parentID -> GFF3Gene dict on top of the streaming iterator.
+    # typeFilter: optional GFF3TypeFilter, lines of other types are skipped.
+    def GetLineOfFileStream(self, fs, typeFilter = None, printComments = False):
+        for item in self.IterItems(fs, printComments = printComments, typeFilter = typeFilter):
+            self.AddItem(item)
 
-            if (IsComment(line)):
-                print(i, ": [Comment] ", line)
-                continue
+        pass
+
+    # same result as GetLineOfFileStream, but the file is split into newline-
+    # aligned byte ranges that are parsed in a process pool. the workers send
+    # back the parsed columns of their chunk and its rows grouped by parentID;
+    # here the groups of all chunks are only merged in file order, so children
+    # whose parent lies in another chunk end up in the same GFF3Gene. the
+    # GFF3Items of a chunk are built when a group holding them is first read
+    # (see GFF3Gene.children).
+    # compressed input has no byte ranges to split at and is parsed as a stream.
+    def GetLineOfFileParallel(self, filePath, processes = None, chunks = None, typeFilter = None):
+        if (IsGzipFile(filePath)):
+            with GFF3Parser.OpenFile(filePath) as fs:
+                self.GetLineOfFileStream(fs, typeFilter)
+            return
+
+        if (processes is None):
+            processes = os.cpu_count() or 1
+        if (chunks is None):
+            chunks = processes * 4
+
+        ranges = GFF3Parser.GetChunkRanges(filePath, chunks)
+        tasks = [(filePath, start, end, typeFilter) for start, end in ranges]
+
+        with Pool(processes) as pool:
+            for columns, groups in pool.imap(ParseFileChunk, tasks):
+                chunk = GFF3ItemChunk(columns)
+                for parentID, rows in groups.items():
+                    gene = self.items.get(parentID)
+                    if (gene is None):
+                        gene = GFF3Gene()
+                        gene.SetName(parentID)
+                        self.items[parentID] = gene
+                    gene.AppendRows(chunk, rows)
 
-            item = GFF3Parser.ProcessLine(line)
-            self.items.setdefault(item.parentID, GFF3Gene())
-            self.items[item.parentID].SetName(item.parentID)
-            self.items[item.parentID].Append(item)
-            # print(i, ": [Item] ", line)
-        
         pass
 
+    # byte offset of the "##FASTA" directive of a plain file, or its size if it
+    # has none.
+    @staticmethod
+    def GetFastaOffset(filePath):
+        with open(filePath, mode='rb') as f:
+            offset = GFF3Parser.FindFastaOffset(f)
+        return os.path.getsize(filePath) if offset is None else offset
+
+    # offset of the "##FASTA" directive in a binary stream positioned at its
+    # start (e.g. from OpenBinary, for compressed files), or None if it has none.
+    # the stream is read in large blocks, not line by line.
+    @staticmethod
+    def FindFastaOffset(f):
+        directive = b"##FASTA"
+        head = f.read(len(directive))
+        if (head == directive):
+            return 0
+
+        # blocks overlap by the length of the pattern, so a match straddling
+        # two blocks is found in the second one
+        pattern = b"\n" + directive
+        position = len(head)
+        tail = head
+        while (True):
+            block = f.read(1 << 20)
+            if (not block):
+                return None
+            data = tail + block
+            found = data.find(pattern)
+            if (found >= 0):
+                return position - len(tail) + found + 1
+            tail = data[-len(pattern):]
+            position += len(block)
+
+    # split the feature section of a file (everything before "##FASTA") into at
+    # most `chunks` byte ranges, each ending at a newline.
+    @staticmethod
+    def GetChunkRanges(filePath, chunks):
+        size = GFF3Parser.GetFastaOffset(filePath)
+        chunkSize = max(1, size // max(1, chunks))
+
+        ranges = []
+        with open(filePath, mode='rb') as f:
+            start = 0
+            while (start < size):
+                f.seek(min(start + chunkSize, size))
+                f.readline()
+                end = min(f.tell(), size)
+                ranges.append((start, end))
+                start = end
+
+        return ranges
+
+    # an item with several parents is added to the group of each of them.
+    def AddItem(self, item):
+        for parentID in (item.parentIDs or [""]):
+            self.items.setdefault(parentID, GFF3Gene())
+            self.items[parentID].SetName(parentID)
+            self.items[parentID].Append(item)
+
     def GetItems(self):
         return self.items
 
+    # yield the split columns of every feature line, without keeping anything
+    # in memory. if blockEnds is True, None is yielded for every "###" directive.
+    # with a typeFilter, only the first three columns of a line are split before
+    # its type is checked, rejected lines are never split further.
+    # iteration stops at the "##FASTA" directive (see GFF3Fasta).
+    @staticmethod
+    def IterFields(fs, printComments = False, blockEnds = False, typeFilter = None):
+        for i, line in enumerate(fs):
+
+            if (IsComment(line)):
+                if (IsFastaStart(line)):
+                    break
+                if (blockEnds and IsBlockEnd(line)):
+                    yield None
+                if (printComments):
+                    print(i, ": [Comment] ", line)
+                continue
+
+            line = line.rstrip("\r\n")
+            if (not line or line.startswith("#")):
+                continue
+
+            if (typeFilter is None):
+                yield line.split("\t")
+                continue
+
+            strs = line.split("\t", 3)
+            if (len(strs) < 4 or not typeFilter.Accept(strs[2])):
+                continue
+            strs[3:] = strs[3].split("\t")
+            yield strs
+
+    # yield one GFF3Item per feature line (None for "###" if blockEnds is True).
+    @staticmethod
+    def IterItems(fs, printComments = False, blockEnds = False, typeFilter = None):
+        for strs in GFF3Parser.IterFields(fs, printComments, blockEnds, typeFilter):
+            yield None if strs is None else GFF3Item(strs)
+
+    # fill a GFF3FeatureStore straight from the split columns, no GFF3Item is built.
+    @staticmethod
+    def FillStore(fs, store = None, typeFilter = None):
+        if (store is None):
+            store = GFF3FeatureStore()
+        for strs in GFF3Parser.IterFields(fs, typeFilter = typeFilter):
+            attributes = GFF3Attributes(strs[8])
+            store.AppendFields(strs, attributes.GetID(), attributes.GetParentIDs())
+        return store
+
+    # columnar store of filePath, memory-mapped from its parse cache (see
+    # GFF3ParseCache) while that is still valid; otherwise the file is parsed and
+    # the cache is written for the next run.
+    @staticmethod
+    def LoadStore(filePath, useCache = True):
+        if (useCache):
+            store = ReadCache(filePath)
+            if (store is not None):
+                return store
+
+        with GFF3Parser.OpenFile(filePath) as fs:
+            store = GFF3Parser.FillStore(fs)
+
+        if (useCache):
+            WriteCache(store, filePath)
+        return store
+
+    # yield one GFF3Gene per top-level feature, once its block is complete.
+    # the group is named after the top-level feature, which is its first child,
+    # followed by all of its descendants in file order; a feature with parents
+    # under several top-level features is in each of their groups.
+    # a block ends at a "###" directive or at the end of the file. features
+    # whose top-level feature is not in their block are held back until a later
+    # block brings it; those never resolved are yielded at the end, grouped by
+    # their first parentID (such groups do not start with a top-level feature).
+    @staticmethod
+    def IterGenes(fs, typeFilter = None):
+        block = []
+        pending = {}
+        byParent = {}
+        counter = itertools.count()
+
+        for item in GFF3Parser.IterItems(fs, blockEnds = True, typeFilter = typeFilter):
+            if (item is not None):
+                block.append(item)
+                continue
+
+            yield from GFF3Parser.CloseBlock(block, pending, byParent, counter)
+            block = []
+
+        yield from GFF3Parser.CloseBlock(block, pending, byParent, counter)
+
+        orphans = {}
+        for order, item in pending.values():
+            if (item.parentID not in orphans):
+                orphans[item.parentID] = GFF3Gene()
+                orphans[item.parentID].SetName(item.parentID)
+            orphans[item.parentID].Append(item)
+        yield from orphans.values()
+
+    # groups of one block, together with the held back items (pending: id ->
+    # (file order, item); byParent: parentID -> items) that descend from its
+    # features. the items of the block left unresolved are held back in turn,
+    # numbered by counter.
+    @staticmethod
+    def CloseBlock(block, pending, byParent, counter):
+        pulled = []
+        frontier = [item.ID for item in block if item.ID]
+        while (frontier and byParent):
+            found = []
+            for ID in frontier:
+                for item in byParent.pop(ID, ()):
+                    entry = pending.pop(id(item), None)
+                    if (entry is not None):
+                        pulled.append(entry)
+                        if (item.ID):
+                            found.append(item.ID)
+            frontier = found
+
+        pulled.sort(key=lambda entry: entry[0])
+        genes, unresolved = GFF3Parser.GetBlockGenes([item for order, item in pulled] + block)
+
+        for item in unresolved:
+            pending[id(item)] = (next(counter), item)
+            for parentID in item.parentIDs:
+                byParent.setdefault(parentID, []).append(item)
+
+        return genes
+
+    # split one block of items into its per-top-level-feature groups; returns
+    # (groups, items none of whose parents lead to a top-level feature of the
+    # block).
+    @staticmethod
+    def GetBlockGenes(block):
+        # top-level features reachable from every ID of the block
+        roots = {}
+        for item in block:
+            if (not item.parentIDs and item.ID):
+                roots.setdefault(item.ID, set()).add(item.ID)
+
+        changed = True
+        while (changed):
+            changed = False
+            for item in block:
+                if (not item.ID or not item.parentIDs):
+                    continue
+                found = roots.setdefault(item.ID, set())
+                size = len(found)
+                for parentID in item.parentIDs:
+                    found |= roots.get(parentID, set())
+                changed |= len(found) != size
+
+        # top-level features first, so each group starts with its own
+        genes = {}
+        for item in block:
+            if (not item.parentIDs):
+                key = item.ID if item.ID else id(item)
+                if (key not in genes):
+                    genes[key] = GFF3Gene()
+                    genes[key].SetName(item.ID)
+                genes[key].Append(item)
+
+        unresolved = []
+        for item in block:
+            if (not item.parentIDs):
+                continue
+            found = set()
+            for parentID in item.parentIDs:
+                found |= roots.get(parentID, set())
+            if (not found):
+                unresolved.append(item)
+            for key in found:
+                genes[key].Append(item)
+
+        return list(genes.values()), unresolved
+
     @staticmethod
     def ProcessLine(line):
         strs = line.split("\t")
         return GFF3Item(strs)
 
-            
 
 
-    
\ No newline at end of file
+
+
@@ -44,6 +44,12 @@ g_valid_types = set({
 # 1st order
 g_gene_type = "gene"
 
+g_gene_types = set({
+    "gene",
+    "ncRNA_gene",
+    "pseudogene"
+    })
+
 # 2nd order
 g_rna_types = set({
     "mRNA",
@@ -55,4 +61,23 @@ g_rna_types = set({
 g_exon_types = set({
     "CDS",
     "exon"
-    })
\ No newline at end of file
+    })
+
+g_exon_type = "exon"
+g_cds_type = "CDS"
+
+# derived from exon/CDS coordinates
+g_intron_type = "intron"
+g_five_prime_utr_type = "five_prime_UTR"
+g_three_prime_utr_type = "three_prime_UTR"
+
+# categorical codes of the type column. every type above has a fixed code, so
+# classification is an int comparison against the code sets below; other types
+# get the next free code the first time they are seen (GFF3Utils.GetTypeCode).
+g_type_names = sorted(g_valid_types | g_gene_types | g_rna_types | g_exon_types)
+g_type_codes = { type : code for code, type in enumerate(g_type_names) }
+
+g_gene_type_code = g_type_codes[g_gene_type]
+g_gene_type_codes = frozenset(g_type_codes[type] for type in g_gene_types)
+g_rna_type_codes = frozenset(g_type_codes[type] for type in g_rna_types)
+g_exon_type_codes = frozenset(g_type_codes[type] for type in g_exon_types)
@@ -0,0 +1,301 @@
+import argparse
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+
+import GFF3ParserGlobalDefs
+from GFF3IntervalIndex import GFF3IntervalIndex
+from GFF3Parser import GFF3Parser
+from sjh_gff3_parser import GetStructureItem
+
+# local HTTP/JSON query service over one or more GFF3 files.
+# every file is loaded once into a GFF3FeatureStore (through its parse cache)
+# with an interval index, and all queries are answered from memory on one
+# asyncio event loop; connections are kept alive, so a client pays for the
+# TCP handshake only once.
+#   GET  /files
+#   GET  /gene?id=<gene ID>[&file=<name>]          same dict as sjh_gff3_parser
+#   GET  /genes?ids=<ID>,<ID>,...[&file=<name>]
+#   GET  /feature?id=<ID>[&file=<name>]
+#   GET  /region?seqid=<seqid>&start=<n>&end=<n>[&type=<type>,...][&file=<name>]
+#   POST /batch   body: JSON list of {"query": "gene"|"feature"|"region", ...}
+# file defaults to the only loaded file; names are the file base names.
+# encoded gene structures are kept in an LRU cache, so hot genes are served
+# without touching the store.
+
+g_default_port = 8765
+g_cache_size = 4096
+g_field_names = ("seqid", "source", "type", "start", "end", "score", "strand", "phase", "attributes")
+
+g_reasons = { 200 : "OK", 400 : "Bad Request", 404 : "Not Found", 405 : "Method Not Allowed",
+              500 : "Internal Server Error" }
+
+
+class QueryError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# typed query parameters. params come from a query string (all strings) or a
+# batch item (any JSON value); a missing or mistyped parameter is a 400.
+def GetStringParam(params, name, required = True):
+    value = params.get(name)
+    if (value is None):
+        if (required):
+            raise QueryError(400, "missing parameter " + name)
+        return None
+    if (not isinstance(value, str)):
+        raise QueryError(400, "parameter " + name + " must be a string")
+    return value
+
+
+def GetIntParam(params, name):
+    value = params.get(name)
+    if (value is None):
+        raise QueryError(400, "missing parameter " + name)
+    if (isinstance(value, int) and not isinstance(value, bool)):
+        return value
+    if (isinstance(value, str) and value.strip().lstrip("+-").isdigit() and value.strip().isascii()):
+        return int(value)
+    raise QueryError(400, "parameter " + name + " must be an integer")
+
+
+# list of strings, given as a JSON list or a comma separated string.
+def GetListParam(params, name, required = True):
+    value = params.get(name)
+    if (value is None):
+        if (required):
+            raise QueryError(400, "missing parameter " + name)
+        return None
+    if (isinstance(value, str)):
+        return value.split(",")
+    if (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+        return value
+    raise QueryError(400, "parameter " + name + " must be a list of strings")
+
+
+class GFF3Dataset:
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.name = os.path.basename(filePath)
+        self.store = GFF3Parser.LoadStore(filePath)
+        self.intervals = GFF3IntervalIndex(self.store)
+
+    def GetFeature(self, row):
+        feature = dict(zip(g_field_names, self.store.GetFields(row)))
+        feature["start"] = int(feature["start"])
+        feature["end"] = int(feature["end"])
+        feature["ID"] = self.store.GetID(row)
+        return feature
+
+    def GetFeatures(self, ID):
+        return [self.GetFeature(row) for row in self.store.GetRowsByID(ID).tolist()]
+
+    def GetRegion(self, seqid, start, end, types = None):
+        rows = self.intervals.Overlapping(seqid, start, end)
+        if (types is not None):
+            typeCodes = self.store.GetColumn("type")
+            wanted = { self.store.pools["type"].Find(type) for type in types }
+            rows = [row for row in rows.tolist() if typeCodes[row] in wanted]
+        else:
+            rows = rows.tolist()
+        return [self.GetFeature(row) for row in sorted(rows)]
+
+    # same dict as sjh_gff3_parser.GetGeneStructure, {} if there is no such gene.
+    def GetGeneStructure(self, gene_id):
+        store = self.store
+        gene_structure = {}
+
+        for row in store.GetRowsByID(gene_id).tolist():
+            gene_structure = GetStructureItem(store.GetFields(row), gene_id)
+        if not gene_structure:
+            return gene_structure
+
+        for row in store.GetChildRows(gene_id).tolist():
+            two_fields = store.GetFields(row)
+            two_item = GetStructureItem(two_fields, store.GetID(row))
+
+            if two_fields[2] in GFF3ParserGlobalDefs.g_rna_types:
+                gene_structure['children'].append(two_item)
+                for three_row in store.GetChildRows(two_item['name']).tolist():
+                    two_item['sub_feature'].append(GetStructureItem(store.GetFields(three_row), store.GetID(three_row)))
+            else:
+                gene_structure['sub_feature'].append(two_item)
+
+        return gene_structure
+
+
+
+class GFF3QueryService:
+
+    def __init__(self, filePaths, cacheSize = g_cache_size):
+        self.datasets = OrderedDict()
+        for filePath in filePaths:
+            dataset = GFF3Dataset(filePath)
+            self.datasets[dataset.name] = dataset
+
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+
+    def GetDataset(self, name):
+        if (name is None):
+            if (len(self.datasets) != 1):
+                raise QueryError(400, "file is required when several files are loaded")
+            return next(iter(self.datasets.values()))
+        dataset = self.datasets.get(name)
+        if (dataset is None):
+            raise QueryError(404, "unknown file " + name)
+        return dataset
+
+    # encoded gene structure, from the LRU cache if it is hot.
+    def GetGeneJSON(self, dataset, gene_id):
+        key = (dataset.name, gene_id)
+        encoded = self.cache.get(key)
+        if (encoded is not None):
+            self.cache.move_to_end(key)
+            return encoded
+
+        gene_structure = dataset.GetGeneStructure(gene_id)
+        if not gene_structure:
+            raise QueryError(404, "unknown gene " + gene_id)
+        encoded = json.dumps(gene_structure, ensure_ascii=False)
+        self.cache[key] = encoded
+        if (len(self.cache) > self.cacheSize):
+            self.cache.popitem(last=False)
+        return encoded
+
+    # answer one query given as a dict of parameters; returns encoded JSON.
+    def Query(self, query, params):
+        if (not isinstance(query, str)):
+            raise QueryError(400, "query must be a string")
+        if (query == "files"):
+            return json.dumps(list(self.datasets.keys()))
+        if (query not in ("gene", "genes", "feature", "region")):
+            raise QueryError(404, "unknown query " + query)
+
+        dataset = self.GetDataset(GetStringParam(params, "file", False))
+        if (query == "gene"):
+            return self.GetGeneJSON(dataset, GetStringParam(params, "id"))
+        if (query == "genes"):
+            ids = GetListParam(params, "ids")
+            return "{" + ",".join(json.dumps(ID) + ":" + self.GetGeneJSON(dataset, ID) for ID in ids) + "}"
+        if (query == "feature"):
+            return json.dumps(dataset.GetFeatures(GetStringParam(params, "id")), ensure_ascii=False)
+
+        region = dataset.GetRegion(GetStringParam(params, "seqid"), GetIntParam(params, "start"), GetIntParam(params, "end"),
+                                   GetListParam(params, "type", False))
+        return json.dumps(region, ensure_ascii=False)
+
+    # several queries in one request; failed ones are answered with their error.
+    def QueryBatch(self, queries):
+        if (not isinstance(queries, list)):
+            raise QueryError(400, "batch body must be a JSON list")
+
+        results = []
+        for params in queries:
+            try:
+                if (not isinstance(params, dict)):
+                    raise QueryError(400, "a batch query must be a JSON object")
+                results.append(self.Query(params.get("query", ""), params))
+            except QueryError as e:
+                results.append(json.dumps({ "error" : str(e), "status" : e.status }))
+        return "[" + ",".join(results) + "]"
+
+    # (status, body) of one HTTP request.
+    def Handle(self, method, target, body):
+        url = urlsplit(target)
+        query = url.path.strip("/")
+
+        try:
+            if (query == "batch"):
+                if (method != "POST"):
+                    raise QueryError(405, "use POST for batches")
+                try:
+                    queries = json.loads(body.decode('utf-8'))
+                except ValueError:
+                    raise QueryError(400, "batch body is not valid JSON")
+                return 200, self.QueryBatch(queries)
+
+            if (method != "GET"):
+                raise QueryError(405, "use GET for " + query)
+            params = { key : values[-1] for key, values in parse_qs(url.query).items() }
+            return 200, self.Query(query, params)
+        except QueryError as e:
+            return e.status, json.dumps({ "error" : str(e) })
+        except Exception as e:
+            # a bad request must never drop the connection without an answer
+            return 500, json.dumps({ "error" : "%s: %s" % (type(e).__name__, e) })
+
+    async def HandleConnection(self, reader, writer):
+        try:
+            while (True):
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+
+                lines = head.decode('latin-1').split("\r\n")
+                requestLine = lines[0].split()
+                if (len(requestLine) != 3):
+                    break
+                method, target, version = requestLine
+
+                headers = {}
+                for line in lines[1:]:
+                    key, sep, value = line.partition(":")
+                    if (sep):
+                        headers[key.strip().lower()] = value.strip()
+
+                # without a valid length the body cannot be skipped, so the
+                # connection is closed after the error
+                length = headers.get("content-length", "0")
+                if (not (length.isascii() and length.isdigit())):
+                    await self.WriteResponse(writer, 400, json.dumps({ "error" : "invalid Content-Length" }), False)
+                    break
+                length = int(length)
+                body = await reader.readexactly(length) if length else b""
+
+                status, response = self.Handle(method, target, body)
+                keepAlive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                await self.WriteResponse(writer, status, response, keepAlive)
+
+                if (not keepAlive):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def WriteResponse(self, writer, status, response, keepAlive):
+        data = response.encode('utf-8')
+        writer.write(("HTTP/1.1 %d %s\r\n"
+                      "Content-Type: application/json; charset=utf-8\r\n"
+                      "Content-Length: %d\r\n"
+                      "Connection: %s\r\n\r\n" % (status, g_reasons.get(status, ""), len(data),
+                                                  "keep-alive" if keepAlive else "close")).encode('latin-1'))
+        writer.write(data)
+        await writer.drain()
+
+    async def Serve(self, host = "127.0.0.1", port = g_default_port):
+        server = await asyncio.start_server(self.HandleConnection, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve gene structure, ID and region queries over GFF3 files")
+    parser.add_argument("files", nargs="+", help="GFF3 files (plain, gzip or BGZF)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=g_default_port)
+    parser.add_argument("--cache", type=int, default=g_cache_size, help="number of cached gene structures")
+    args = parser.parse_args()
+
+    service = GFF3QueryService(args.files, args.cache)
+    print("serving", ", ".join(service.datasets.keys()), "on", args.host + ":" + str(args.port))
+    asyncio.run(service.Serve(args.host, args.port))
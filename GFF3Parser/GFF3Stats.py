@@ -0,0 +1,238 @@
+import os
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy
+
+from GFF3ParserGlobalDefs import *
+from GFF3Compression import IsGzipFile
+from GFF3FeatureStore import StringPool
+from GFF3Parser import GFF3Parser
+from GFF3Utils import GetParentIDs
+
+# one-pass annotation statistics: per-type feature counts and length
+# distributions, exons per transcript and per-seqid gene density.
+# Add only interns the type and seqid of a line and buffers its columns; every
+# g_stats_batch lines the buffer is reduced into the accumulators with bincount
+# and ufunc.at, so there is no per-feature arithmetic in Python. lengths are
+# binned by powers of two, so partial results of different chunks have the
+# same bins and Merge simply adds them up.
+# feature lines with fewer than 9 columns or non-numeric coordinates are not
+# accounted; they are counted, with the first few kept as examples, and listed
+# in the summary, whether the file is read as a stream or in chunks.
+
+g_stats_batch = 65536
+g_length_bins = 64
+g_malformed_examples = 5
+
+
+class GFF3Stats:
+
+    def __init__(self):
+        self.types = StringPool()
+        self.seqids = StringPool()
+
+        # per type code
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.lengthSums = numpy.zeros(0, dtype=numpy.int64)
+        self.minLengths = numpy.zeros(0, dtype=numpy.int64)
+        self.maxLengths = numpy.zeros(0, dtype=numpy.int64)
+        # per type code and floor(log2(length))
+        self.lengthBins = numpy.zeros((0, g_length_bins), dtype=numpy.int64)
+
+        # per seqid code
+        self.genes = numpy.zeros(0, dtype=numpy.int64)
+        self.extents = numpy.zeros(0, dtype=numpy.int64)
+
+        # parentID -> exon count
+        self.exons = Counter()
+
+        self.malformed = 0
+        self.malformedExamples = []
+
+        self.batchTypes = []
+        self.batchSeqids = []
+        self.batchStarts = []
+        self.batchEnds = []
+        self.batchParents = []
+
+    # account one feature from the 9 split columns of a GFF3 line.
+    def Add(self, strs):
+        if (len(strs) < 9 or not IsCoordinate(strs[3]) or not IsCoordinate(strs[4])):
+            self.malformed += 1
+            if (len(self.malformedExamples) < g_malformed_examples):
+                self.malformedExamples.append("\t".join(strs))
+            return
+
+        self.batchTypes.append(self.types.Intern(strs[2]))
+        self.batchSeqids.append(self.seqids.Intern(strs[0]))
+        self.batchStarts.append(strs[3])
+        self.batchEnds.append(strs[4])
+        if (strs[2] == g_exon_type):
+            self.batchParents.extend(GetParentIDs(strs[8]))
+
+        if (len(self.batchTypes) >= g_stats_batch):
+            self.Flush()
+
+    # account every feature line of a stream.
+    def AddStream(self, fs, typeFilter = None):
+        for strs in GFF3Parser.IterFields(fs, typeFilter = typeFilter):
+            self.Add(strs)
+        self.Flush()
+        return self
+
+    # grow the per-code accumulators to the current pool sizes.
+    def Resize(self):
+        types = len(self.types) - len(self.counts)
+        if (types > 0):
+            self.counts = numpy.r_[self.counts, numpy.zeros(types, dtype=numpy.int64)]
+            self.lengthSums = numpy.r_[self.lengthSums, numpy.zeros(types, dtype=numpy.int64)]
+            self.minLengths = numpy.r_[self.minLengths, numpy.full(types, numpy.iinfo(numpy.int64).max)]
+            self.maxLengths = numpy.r_[self.maxLengths, numpy.zeros(types, dtype=numpy.int64)]
+            self.lengthBins = numpy.vstack((self.lengthBins, numpy.zeros((types, g_length_bins), dtype=numpy.int64)))
+
+        seqids = len(self.seqids) - len(self.genes)
+        if (seqids > 0):
+            self.genes = numpy.r_[self.genes, numpy.zeros(seqids, dtype=numpy.int64)]
+            self.extents = numpy.r_[self.extents, numpy.zeros(seqids, dtype=numpy.int64)]
+
+    # reduce the buffered lines into the accumulators.
+    def Flush(self):
+        self.Resize()
+        if (not self.batchTypes):
+            return
+
+        types = numpy.array(self.batchTypes, dtype=numpy.int64)
+        seqids = numpy.array(self.batchSeqids, dtype=numpy.int64)
+        starts = numpy.array(self.batchStarts).astype(numpy.int64)
+        ends = numpy.array(self.batchEnds).astype(numpy.int64)
+        lengths = numpy.maximum(ends - starts + 1, 1)
+
+        size = len(self.types)
+        self.counts += numpy.bincount(types, minlength=size)
+        self.lengthSums += numpy.bincount(types, weights=lengths, minlength=size).astype(numpy.int64)
+        numpy.minimum.at(self.minLengths, types, lengths)
+        numpy.maximum.at(self.maxLengths, types, lengths)
+
+        bins = numpy.minimum(numpy.log2(lengths).astype(numpy.int64), g_length_bins - 1)
+        self.lengthBins += numpy.bincount(types * g_length_bins + bins,
+                                          minlength=size * g_length_bins).reshape(size, g_length_bins)
+
+        geneCodes = [self.types.Find(type) for type in g_gene_types]
+        isGene = numpy.isin(types, [code for code in geneCodes if code >= 0])
+        self.genes += numpy.bincount(seqids[isGene], minlength=len(self.seqids))
+        numpy.maximum.at(self.extents, seqids, ends)
+
+        self.exons.update(self.batchParents)
+
+        self.batchTypes = []
+        self.batchSeqids = []
+        self.batchStarts = []
+        self.batchEnds = []
+        self.batchParents = []
+
+    # add the (flushed) partial result of another chunk to this one.
+    def Merge(self, other):
+        self.Flush()
+        other.Flush()
+
+        typeCodes = numpy.array([self.types.Intern(s) for s in other.types.strings], dtype=numpy.int64)
+        seqidCodes = numpy.array([self.seqids.Intern(s) for s in other.seqids.strings], dtype=numpy.int64)
+        self.Resize()
+
+        if (len(typeCodes)):
+            numpy.add.at(self.counts, typeCodes, other.counts)
+            numpy.add.at(self.lengthSums, typeCodes, other.lengthSums)
+            numpy.minimum.at(self.minLengths, typeCodes, other.minLengths)
+            numpy.maximum.at(self.maxLengths, typeCodes, other.maxLengths)
+            numpy.add.at(self.lengthBins, typeCodes, other.lengthBins)
+        if (len(seqidCodes)):
+            numpy.add.at(self.genes, seqidCodes, other.genes)
+            numpy.maximum.at(self.extents, seqidCodes, other.extents)
+
+        self.exons.update(other.exons)
+
+        self.malformed += other.malformed
+        self.malformedExamples += other.malformedExamples[:g_malformed_examples - len(self.malformedExamples)]
+        return self
+
+    # exon count -> number of transcripts with that many exons.
+    def GetExonHistogram(self):
+        if (not self.exons):
+            return {}
+        counts = numpy.bincount(numpy.fromiter(self.exons.values(), dtype=numpy.int64, count=len(self.exons)))
+        return { n : int(counts[n]) for n in numpy.flatnonzero(counts).tolist() }
+
+    # plain dict of all statistics, ready for json.dumps. length histograms are
+    # keyed by the lower bound of their power-of-two bin. gene density is genes
+    # per Mb of the seqid extent (the largest feature end seen on it).
+    def GetSummary(self):
+        self.Flush()
+
+        types = {}
+        for code, type in enumerate(self.types.strings):
+            count = int(self.counts[code])
+            types[type] = {
+                "count" : count,
+                "totalLength" : int(self.lengthSums[code]),
+                "minLength" : int(self.minLengths[code]),
+                "maxLength" : int(self.maxLengths[code]),
+                "meanLength" : float(self.lengthSums[code]) / count,
+                "lengthHistogram" : { 1 << b : int(self.lengthBins[code, b])
+                                      for b in numpy.flatnonzero(self.lengthBins[code]).tolist() },
+                }
+
+        seqids = {}
+        for code, seqid in enumerate(self.seqids.strings):
+            extent = int(self.extents[code])
+            seqids[seqid] = {
+                "genes" : int(self.genes[code]),
+                "extent" : extent,
+                "genesPerMb" : float(self.genes[code]) * 1e6 / extent if extent else 0.0,
+                }
+
+        return {
+            "types" : types,
+            "exonsPerTranscript" : self.GetExonHistogram(),
+            "seqids" : seqids,
+            "malformedLines" : {
+                "count" : self.malformed,
+                "examples" : self.malformedExamples,
+                },
+            }
+
+
+def IsCoordinate(s):
+    return s.isascii() and s.isdigit()
+
+
+# worker of ComputeStats: statistics of the newline-aligned byte range [start, end).
+def GetChunkStats(args):
+    filePath, start, end, typeFilter = args
+    with open(filePath, mode='rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # the chunks end at the "##FASTA" directive (see GFF3Parser.GetChunkRanges),
+    # so every line is checked by Add as in a stream
+    return GFF3Stats().AddStream(data.decode('utf-8').splitlines(), typeFilter)
+
+
+# statistics of a whole file. plain files are split into byte ranges whose
+# partial results are computed in a process pool and merged; compressed files
+# are read as one stream.
+def ComputeStats(filePath, processes = None, typeFilter = None):
+    if (processes == 1 or IsGzipFile(filePath)):
+        with GFF3Parser.OpenFile(filePath) as fs:
+            return GFF3Stats().AddStream(fs, typeFilter)
+
+    if (processes is None):
+        processes = os.cpu_count() or 1
+
+    ranges = GFF3Parser.GetChunkRanges(filePath, processes * 4)
+    tasks = [(filePath, start, end, typeFilter) for start, end in ranges]
+
+    stats = GFF3Stats()
+    with Pool(processes) as pool:
+        for chunk in pool.imap(GetChunkStats, tasks):
+            stats.Merge(chunk)
+    return stats
@@ -1,56 +1,224 @@
-import re
+from collections.abc import Mapping
+from sys import intern
+from urllib.parse import unquote
+
 from GFF3ParserGlobalDefs import *
 
-reFindParent = re.compile("Parent=([^;]+);")
 
+# column 9 tokenizer shared by every parser entry point.
+# the column is split once into raw key -> value strings; a value is only
+# URL-unescaped the first time its key is accessed.
+class GFF3Attributes(Mapping):
+
+    __slots__ = ("raw", "decoded")
+
+    def __init__(self, info):
+        raw = {}
+        for field in info.split(";"):
+            key, sep, value = field.partition("=")
+            if (sep):
+                raw[key.strip()] = value.strip()
+
+        self.raw = raw
+        self.decoded = {}
+
+    def __getitem__(self, key):
+        value = self.decoded.get(key)
+        if (value is None):
+            value = Unescape(self.raw[key])
+            self.decoded[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    # multi-valued attributes such as Parent=a,b; escaped commas (%2C) are kept
+    # inside their value.
+    def GetValues(self, key):
+        value = self.raw.get(key)
+        if (not value):
+            return []
+        return [Unescape(v) for v in value.split(",") if v]
+
+    def GetID(self):
+        return self.get("ID", "")
 
+    def GetParentIDs(self):
+        return self.GetValues("Parent")
+
+
+def Unescape(value):
+    return unquote(value) if "%" in value else value
+
+
+def GetParentIDs(str):
+    return GFF3Attributes(str).GetParentIDs()
+
+
+# first parent, "" for top-level features.
 def GetParentID(str):
-    m = reFindParent.findall(str)
-    if (len(m) == 1):
-        return m[0]
-    else:
-        return ""
+    parentIDs = GetParentIDs(str)
+    return parentIDs[0] if parentIDs else ""
+
+
+def GetID(str):
+    return GFF3Attributes(str).GetID()
+
+
+# include/exclude filter on the type column (column 3). the parsers check it right
+# after splitting off the first three columns, before the rest of the line, the
+# attributes or any object is touched.
+class GFF3TypeFilter:
+
+    def __init__(self, include = None, exclude = None):
+        self.include = None if include is None else frozenset(include)
+        self.exclude = frozenset(exclude) if exclude else frozenset()
+
+    def Accept(self, type):
+        if (self.include is not None and type not in self.include):
+            return False
+        return type not in self.exclude
+
+
+# categorical code of a type; types missing from g_type_codes get the next free
+# code the first time they are seen in this process.
+def GetTypeCode(type):
+    code = g_type_codes.get(type)
+    if (code is None):
+        code = len(g_type_names)
+        g_type_codes[type] = code
+        g_type_names.append(type)
+    return code
 
 
 class GFF3Item:
 
+    # the repetitive columns (seqid, source, type, strand, phase) are interned, so
+    # all items share one string object per distinct value, and the type is also
+    # kept as its categorical code for the Is* checks.
+    __slots__ = ("mark", "name", "type", "typeCode", "startIdx", "endIdx", "attr1", "attr2", "attr3", "info",
+                 "ID", "parentIDs", "parentID")
+
     def __init__(self, strs):
-        self.mark = strs[0]
-        self.name = strs[1]
-        self.type = strs[2]
+        self.mark = intern(strs[0])
+        self.name = intern(strs[1])
+        self.type = intern(strs[2])
+        self.typeCode = GetTypeCode(self.type)
         self.startIdx = strs[3]
         self.endIdx   = strs[4]
         self.attr1 = strs[5]
-        self.attr2 = strs[6]
-        self.attr3 = strs[7]
+        self.attr2 = intern(strs[6])
+        self.attr3 = intern(strs[7])
         self.info = strs[8]
 
         # relational data member
-        self.parentID = GetParentID(self.info)
+        attributes = GFF3Attributes(self.info)
+        self.ID = attributes.GetID()
+        self.parentIDs = attributes.GetParentIDs()
+        self.parentID = self.parentIDs[0] if self.parentIDs else ""
+
+    # items parsed in worker processes are pickled by their columns and parsed
+    # relations, without the type code: codes of non-standard types differ
+    # between processes. unpickled strings are not interned, so the repetitive
+    # columns are interned again; column 9 is not parsed again.
+    def __getstate__(self):
+        return (self.mark, self.name, self.type, self.startIdx, self.endIdx,
+                self.attr1, self.attr2, self.attr3, self.info, self.ID, self.parentIDs)
+
+    def __setstate__(self, state):
+        (mark, name, type, self.startIdx, self.endIdx,
+         self.attr1, attr2, attr3, self.info, self.ID, self.parentIDs) = state
+        self.mark = intern(mark)
+        self.name = intern(name)
+        self.type = intern(type)
+        self.typeCode = GetTypeCode(self.type)
+        self.attr2 = intern(attr2)
+        self.attr3 = intern(attr3)
+        self.parentID = self.parentIDs[0] if self.parentIDs else ""
+
+    # an item from a __getstate__ tuple, without parsing column 9 again.
+    @staticmethod
+    def FromState(state):
+        item = GFF3Item.__new__(GFF3Item)
+        item.__setstate__(state)
+        return item
+
+    # the 9 GFF3 columns, as split from the line.
+    def GetFields(self):
+        return [self.mark, self.name, self.type, self.startIdx, self.endIdx,
+                self.attr1, self.attr2, self.attr3, self.info]
+
+    # the lazily decoded column 9 mapping.
+    def GetAttributes(self):
+        return GFF3Attributes(self.info)
 
     def IsGene(self):
-        return self.type == g_gene_type
+        return self.typeCode == g_gene_type_code
 
     def IsRNA(self):
-        return self.type in g_rna_types
+        return self.typeCode in g_rna_type_codes
 
     def IsExon(self):
-        return self.type in g_exon_types
+        return self.typeCode in g_exon_type_codes
+
+
+
+# the columns of one chunk parsed by a worker of
+# GFF3Parser.GetLineOfFileParallel, one list per GFF3Item state field (see
+# ParseFileChunk for the parentIDs column). its GFF3Items are built the first
+# time one of them is read, all at once, so an item listed under several
+# parents is still one object.
+class GFF3ItemChunk:
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.items = None
+
+    def GetItems(self, rows):
+        if (self.items is None):
+            parentIDs = [value if isinstance(value, list) else [value] if value else [] for value in self.columns[10]]
+            self.items = [GFF3Item.FromState(state) for state in zip(*self.columns[:10], parentIDs)]
+            self.columns = None
+        items = self.items
+        return [items[row] for row in rows]
 
 
 
 class GFF3Gene:
 
     def __init__(self):
-        self.children = []
+        self.items = []
+        self.chunks = []
         self.ID = ""
-    
+
+    # the GFF3Items of the group, in file order. rows added by AppendRows are
+    # turned into items on first access.
+    @property
+    def children(self):
+        if (self.chunks):
+            for chunk, rows in self.chunks:
+                self.items.extend(chunk.GetItems(rows))
+            self.chunks = []
+        return self.items
+
     def Append(self, item):
         self.children.append(item)
 
+    # add rows of a GFF3ItemChunk, without building their items yet.
+    def AppendRows(self, chunk, rows):
+        self.chunks.append((chunk, rows))
+
     def SetName(self, name):
         self.ID = name
 
+    def FillStore(self, store):
+        for item in self.children:
+            store.AppendItem(item)
+        return store
+
 
 
 class Structure:
@@ -79,3 +247,4 @@ class RNAStructure(Structure):
     def __init__(self):
         super().__init__()
         self.type = "NONE_RNA_TYPE"
+        self.splicedLength = 0
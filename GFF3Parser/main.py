@@ -1,4 +1,5 @@
 from GFF3Parser import *
+from GFF3Exporter import ExportNDJSON
 
 filePath = "H:/dev/R2Us/GFF3Parser/data/small_hailong.gff3"
 
@@ -13,8 +14,10 @@ if __name__ == "__main__":
 
     items = parser.GetItems()
 
-    # TODO: serialize the items into json..
-    
+    # serialize the gene structures into json, one gene per line
+    with GFF3Parser.OpenFile(filePath) as gff3File, open(filePath + ".ndjson", mode='w', encoding='utf-8') as out:
+        ExportNDJSON(gff3File, out)
+
 
     print("Parser end.")
     pass
\ No newline at end of file
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import json
-import re
 import GFF3ParserGlobalDefs
+from GFF3Utils import GFF3Attributes, GetID
+from GFF3OffsetIndex import GFF3OffsetIndex
+from GFF3Compression import OpenText
 
 # gene_id = 'gene0010'
 # gff_file_path = 'D:/sgs-project/sgs/data/small_hailong/small_hailong.gff3'
@@ -10,114 +12,169 @@ gene_id = 'gene-b0537'
 gff_file_path = r'D:\sgs-project\sgs\data\ecoli\ecoli.gff3'
 
 
-def GetParentID(str):
-    reFindParent = re.compile("Parent=([^;]+)")
-    m = reFindParent.findall(str)
-    if (len(m) == 1):
-        # print(m[0])
-        return m[0]
-    else:
-        return ""
-
-
-def GetID(str):
-    reFindID = re.compile("ID=([^;]+);")
-    j = reFindID.findall(str)
-    if (len(j) == 1):
-        # print(j[0])
-        return j[0]
-    else:
-        return ""
-
-
 def GetItems(gff_file_path):
     # generate items store all_information
-    with open(gff_file_path, mode='r', encoding='utf-8') as f:
+    with OpenText(gff_file_path) as f:
         items = {}
         for line in f:
-            item = {}
+            if line.startswith('##FASTA'):
+                break
             if not line.startswith('#'):
                 strs = line.strip().split("\t")
                 types = strs[2]
                 start = strs[3]
                 end = strs[4]
                 strand = strs[6]
-                info = strs[8]
-                ID = GetID(info)
-                parentID = GetParentID(info)
-                item_element = [types, start, end, strand, ID, parentID]
-                item[parentID] = item_element
-                # print(item)
-                if parentID not in items.keys():
-                    items[parentID] = []
-                    items[parentID].append(item)
-                else:
-                    items[parentID].append(item)
+                attributes = GFF3Attributes(strs[8])
+                ID = attributes.GetID()
+                # a feature with several parents is listed under each of them
+                for parentID in (attributes.GetParentIDs() or [""]):
+                    item = {}
+                    item_element = [types, start, end, strand, ID, parentID]
+                    item[parentID] = item_element
+                    # print(item)
+                    if parentID not in items.keys():
+                        items[parentID] = []
+                        items[parentID].append(item)
+                    else:
+                        items[parentID].append(item)
 
         return items
 
 
 
-def GffParser(gene_id):
+def GetStructureItem(strs, name):
+    item = {}
+    item['type'] = strs[2]
+    item['start'] = strs[3]
+    item['end'] = strs[4]
+    item['strand'] = strs[6]
+    item['name'] = name
+    item['children'] = []
+    item['sub_feature'] = []
+    return item
+
+
+# build the gene structure dict of gene_id by seeking to its lines through the
+# sidecar offset index, instead of scanning the whole file.
+def GetGeneStructure(gene_id, index):
     gene_structure = {}
 
-    # one parse gene
-    with open(gff_file_path, mode='r', encoding='utf-8') as f:
-        for line in f:
-            if not line.startswith('#'):
-                gene_line = line.strip().split("\t")
-                gene_id_indo = gene_line[8]
-                ID = GetID(gene_id_indo)
-                if gene_id == ID:
-                    gene_structure['type'] = gene_line[2]
-                    gene_structure['start'] = gene_line[3]
-                    gene_structure['end'] = gene_line[4]
-                    gene_structure['strand'] = gene_line[6]
-                    gene_structure['name'] = gene_id
-                    gene_structure['sub_feature'] = []
-                    gene_structure['children'] = []
-
-
-        items = GetItems(gff_file_path)
-        one_parser = items[gene_id]
-        for i in one_parser:
-            two_parser = i[gene_id]
-            two_type = two_parser[0]
-
-            two_item = {}
-            two_item['type'] = two_parser[0]
-            two_item['start'] = two_parser[1]
-            two_item['end'] = two_parser[2]
-            two_item['strand'] = two_parser[3]
-            two_item['name'] = two_parser[4]
-            two_item['children'] = []
-            two_item['sub_feature'] = []
+    with index.Open() as f:
+        # one parse gene
+        for gene_line in index.ReadFields(f, index.GetOffsetsByID(gene_id)):
+            gene_structure = GetStructureItem(gene_line, gene_id)
+        if not gene_structure:
+            return gene_structure
 
+        for two_parser in index.ReadFields(f, index.GetOffsetsByParent(gene_id)):
+            two_type = two_parser[2]
+            two_item = GetStructureItem(two_parser, GetID(two_parser[8]))
 
             if two_type in GFF3ParserGlobalDefs.g_rna_types:
                 # 存children
-                three_ID = two_parser[4]
-                # print(three_ID)
-                three_parser = items[three_ID]
-                # print(three_parser)
+                three_ID = two_item['name']
                 gene_structure['children'].append(two_item)
-                for j in three_parser:
-                    three_info = j[three_ID]
-                    three_item = {}
-                    three_item['type'] = three_info[0]
-                    three_item['start'] = three_info[1]
-                    three_item['end'] = three_info[2]
-                    three_item['strand'] = three_info[3]
-                    three_item['name'] = three_info[4]
-                    three_item['children'] = []
-                    three_item['sub_feature'] = []
+                for three_info in index.ReadFields(f, index.GetOffsetsByParent(three_ID)):
+                    three_item = GetStructureItem(three_info, GetID(three_info[8]))
                     two_item['sub_feature'].append(three_item)
             else:
                 # 存sub_feature
                 gene_structure['sub_feature'].append(two_item)
 
-        datas_json = json.dumps(gene_structure, indent=2, sort_keys=True, ensure_ascii=False)
-        print(datas_json)
-
-
-GffParser(gene_id)
+    return gene_structure
+
+
+# place one feature line under one of its parents ("" for top-level features)
+# in the structures being built by GetGeneStructures.
+# returns False if that parent is not (yet) a gene or RNA we collect.
+def AddToGeneStructures(strs, ID, parentID, wanted, genes, rnas):
+    if ID and ID not in genes:
+        if wanted is None:
+            is_gene = not parentID and strs[2] in GFF3ParserGlobalDefs.g_gene_types
+        else:
+            is_gene = ID in wanted
+        if is_gene:
+            genes[ID] = GetStructureItem(strs, ID)
+            return True
+
+    if parentID in genes:
+        two_item = GetStructureItem(strs, ID)
+        if strs[2] in GFF3ParserGlobalDefs.g_rna_types:
+            # 存children
+            genes[parentID]['children'].append(two_item)
+            # an RNA shared by several genes has one copy under each of them
+            rnas.setdefault(ID, []).append(two_item)
+        else:
+            # 存sub_feature
+            genes[parentID]['sub_feature'].append(two_item)
+        return True
+
+    if parentID in rnas:
+        for two_item in rnas[parentID]:
+            two_item['sub_feature'].append(GetStructureItem(strs, ID))
+        return True
+
+    return False
+
+
+# build the structures of many genes in a single streaming pass over the file.
+# gene_ids is an iterable of gene IDs, or None for every top-level feature whose
+# type is in g_gene_types. returns a dict gene ID -> gene structure dict.
+# lines whose parent is not placed yet are buffered until the end, unless that
+# parent was already dropped (not wanted, or itself under a dropped parent).
+def GetGeneStructures(gene_ids=None, file_path=gff_file_path):
+    gene_ids = None if gene_ids is None else list(gene_ids)
+    wanted = None if gene_ids is None else set(gene_ids)
+
+    genes = {}
+    rnas = {}
+    dropped = set()
+    pending = []
+
+    with OpenText(file_path) as f:
+        for line in f:
+            if line.startswith('##FASTA'):
+                break
+            if line.startswith('#'):
+                continue
+
+            strs = line.strip().split("\t")
+            if len(strs) < 9:
+                continue
+
+            attributes = GFF3Attributes(strs[8])
+            ID = attributes.GetID()
+            kept = False
+            for parentID in (attributes.GetParentIDs() or [""]):
+                if AddToGeneStructures(strs, ID, parentID, wanted, genes, rnas):
+                    kept = True
+                elif parentID and parentID not in dropped:
+                    pending.append((strs, ID, parentID))
+                    kept = True
+            if ID and not kept:
+                dropped.add(ID)
+
+    # resolve forward references
+    while pending:
+        left = [p for p in pending if not AddToGeneStructures(p[0], p[1], p[2], wanted, genes, rnas)]
+        if len(left) == len(pending):
+            break
+        pending = left
+
+    if gene_ids is None:
+        return genes
+
+    return {ID: genes[ID] for ID in gene_ids if ID in genes}
+
+
+def GffParser(gene_id, file_path=gff_file_path):
+    index = GFF3OffsetIndex.Load(file_path)
+    gene_structure = GetGeneStructure(gene_id, index)
+
+    datas_json = json.dumps(gene_structure, indent=2, sort_keys=True, ensure_ascii=False)
+    print(datas_json)
+
+
+if __name__ == "__main__":
+    GffParser(gene_id)
@@ -2,6 +2,7 @@ import os
 import io
 import re
 import math
+import heapq
 
 from time import time
 
@@ -111,7 +112,8 @@ def CalculateDistance(tfidf_1, tfidf_2, metric = "cosine", dim = 3):
         return DistanceMinkowski(v1, v2, dimension = dim)
 
 
-def GetRanking(query_tfidf, db_tfidf, metric = "cosine"):
+# with k, only the best k results are kept, in a bounded heap instead of a full sort.
+def GetRanking(query_tfidf, db_tfidf, metric = "cosine", k = None):
 
     result = []
 
@@ -121,6 +123,12 @@ def GetRanking(query_tfidf, db_tfidf, metric = "cosine"):
 
     result = list(filter(lambda x: not math.isnan(x[1]), result))
 
+    if k is not None:
+        # ties keep the document order, as in the stable sort below
+        if metric == "cosine":
+            return [(idx, d) for d, neg_idx, idx in heapq.nlargest(k, ((d, -idx, idx) for idx, d in result))]
+        return [(idx, d) for d, idx in heapq.nsmallest(k, ((d, idx) for idx, d in result))]
+
     # sort in descending or ascending order, based on the metric:
     return sorted(result, key = lambda x: x[1], reverse = (metric == "cosine"))
 
@@ -0,0 +1,760 @@
+import heapq
+import os
+from multiprocessing import Pool
+
+import numpy
+
+from SimpleTFIDF import DocumentProcessor
+
+# bounds of one chunk of GetBatchTopK: expanded (query term, posting) pairs, and
+# cells of the dense queries x documents score block
+g_batch_pairs = 1 << 20
+g_batch_cells = 1 << 22
+
+# non-zeros of the delta segment above which it is merged into the base segment
+g_delta_size = 1 << 16
+# fraction of tombstoned non-zeros above which the index is compacted
+g_compact_fraction = 0.25
+
+
+# best k columns of every row of scores, best first, ties by column index;
+# NaN scores are never selected. returns (columns, scores), both rows x k,
+# padded with -1 and NaN.
+def SelectTopK(scores, k, descending = True):
+    rows, columns = scores.shape
+    top_columns = numpy.full((rows, k), -1, dtype=numpy.int64)
+    top_scores = numpy.full((rows, k), numpy.nan)
+    if rows == 0 or columns == 0 or k <= 0:
+        return top_columns, top_scores
+
+    keyed = -scores if descending else scores.copy()
+    keyed[numpy.isnan(keyed)] = numpy.inf
+
+    # entries strictly better than the k-th best key of their row are sorted;
+    # entries equal to it (often many, e.g. zero scores) are already in column
+    # order and fill the ranks that are left, row by row
+    kth = numpy.partition(keyed, min(k, columns) - 1, axis=1)[:, min(k, columns) - 1:min(k, columns)]
+    r, c = numpy.nonzero(keyed < kth)
+    order = numpy.lexsort((c, keyed[r, c], r))
+    r, c = r[order], c[order]
+    rank = numpy.arange(len(r)) - numpy.searchsorted(r, r)
+    better = numpy.bincount(r, minlength=rows)
+
+    top_columns[r, rank] = c
+    top_scores[r, rank] = scores[r, c]
+
+    for row in numpy.flatnonzero((better < k) & numpy.isfinite(kth[:, 0])).tolist():
+        ties = numpy.flatnonzero(keyed[row] == kth[row, 0])[:k - better[row]]
+        top_columns[row, better[row]:better[row] + len(ties)] = ties
+        top_scores[row, better[row]:better[row] + len(ties)] = scores[row, ties]
+    return top_columns, top_scores
+
+
+# the tf part 1 + log tf of the weights of raw counts; 0 for a tombstone.
+def GetTF(counts):
+    tf = numpy.zeros(len(counts), dtype=float)
+    live = counts > 0
+    tf[live] = 1 + numpy.log(counts[live])
+    return tf
+
+
+# worker of SparseTFIDF.AddDocuments: run DocumentProcessor over a chunk of
+# documents and return (words, term ids, counts, non-zeros per document), with
+# term ids local to the chunk; arrays are much cheaper to send back than word
+# dicts.
+def TokenizeChunk(doc_strings):
+    vocabulary = {}
+    indices = []
+    counts = []
+    lengths = []
+    for doc_string in doc_strings:
+        word_dict = DocumentProcessor(doc_string)
+        indices.extend([vocabulary.setdefault(word, len(vocabulary)) for word in word_dict])
+        counts.extend(word_dict.values())
+        lengths.append(len(indices))
+
+    lengths = numpy.diff(numpy.array([0] + lengths, dtype=numpy.int64))
+    return list(vocabulary), numpy.array(indices, dtype=numpy.int64), numpy.array(counts, dtype=numpy.int64), lengths
+
+
+# pointer array extended to number_of_terms terms, for the terms added after it
+# was built.
+def PadPointers(ptr, number_of_terms):
+    return numpy.r_[ptr, numpy.full(number_of_terms + 1 - len(ptr), ptr[-1], dtype=numpy.int64)]
+
+
+# non-zeros (document, term id, raw count) of a part of the corpus, in the order
+# they were added, with their inverted index: the postings of term t are
+# postings_docs/postings_tf[postings_ptr[t]:postings_ptr[t + 1]], and the
+# posting of non-zero i is postings_of[i].
+class Segment:
+
+    def __init__(self, rows, indices, counts, postings_ptr, postings_docs, postings_tf, postings_of):
+        self.rows = rows
+        self.indices = indices
+        self.counts = counts
+
+        self.postings_ptr = postings_ptr
+        self.postings_docs = postings_docs
+        self.postings_tf = postings_tf
+        self.postings_of = postings_of
+
+    # index non-zeros given in their order of addition.
+    @staticmethod
+    def FromNonzeros(rows, indices, counts, number_of_terms):
+        order = numpy.argsort(indices, kind='stable')
+        postings_ptr = numpy.zeros(number_of_terms + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(indices, minlength=number_of_terms), out=postings_ptr[1:])
+        postings_of = numpy.empty(len(order), dtype=numpy.int64)
+        postings_of[order] = numpy.arange(len(order))
+        return Segment(rows, indices, counts, postings_ptr, rows[order], GetTF(counts[order]), postings_of)
+
+    @staticmethod
+    def Empty():
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return Segment.FromNonzeros(empty, empty, empty, 0)
+
+    def __len__(self):
+        return len(self.rows)
+
+    # positions in postings_docs/postings_tf of the postings of the given terms,
+    # one run per term, and the run lengths. terms added after the segment was
+    # built have no postings in it.
+    def GetPostingPositions(self, term_ids):
+        number_of_terms = len(self.postings_ptr) - 1
+        starts = self.postings_ptr[numpy.minimum(term_ids, number_of_terms)]
+        lengths = self.postings_ptr[numpy.minimum(term_ids + 1, number_of_terms)] - starts
+        total = int(lengths.sum())
+        positions = numpy.arange(total) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths) + numpy.repeat(starts, lengths)
+        return positions, lengths
+
+    # tombstone the non-zeros at the given positions of the segment.
+    def Tombstone(self, positions):
+        self.counts[positions] = 0
+        self.postings_tf[self.postings_of[positions]] = 0
+
+    # this segment followed by other as one segment, without sorting: every
+    # posting keeps its rank within its term, and the postings of other come
+    # after those of this segment.
+    def Merge(self, other, number_of_terms):
+        if len(other) == 0:
+            return self
+        if len(self) == 0:
+            return other
+
+        ptr_a = PadPointers(self.postings_ptr, number_of_terms)
+        ptr_b = PadPointers(other.postings_ptr, number_of_terms)
+        df_a = numpy.diff(ptr_a)
+        df_b = numpy.diff(ptr_b)
+        ptr = numpy.zeros(number_of_terms + 1, dtype=numpy.int64)
+        numpy.cumsum(df_a + df_b, out=ptr[1:])
+
+        terms_a = numpy.repeat(numpy.arange(number_of_terms), df_a)
+        terms_b = numpy.repeat(numpy.arange(number_of_terms), df_b)
+        target_a = numpy.arange(len(terms_a)) - ptr_a[terms_a] + ptr[terms_a]
+        target_b = numpy.arange(len(terms_b)) - ptr_b[terms_b] + ptr[terms_b] + df_a[terms_b]
+
+        docs = numpy.empty(ptr[-1], dtype=numpy.int64)
+        docs[target_a] = self.postings_docs
+        docs[target_b] = other.postings_docs
+        tf = numpy.empty(ptr[-1], dtype=float)
+        tf[target_a] = self.postings_tf
+        tf[target_b] = other.postings_tf
+
+        return Segment(numpy.concatenate((self.rows, other.rows)), numpy.concatenate((self.indices, other.indices)),
+                       numpy.concatenate((self.counts, other.counts)), ptr, docs, tf,
+                       numpy.concatenate((target_a[self.postings_of], target_b[other.postings_of])))
+
+
+# sparse TF-IDF engine.
+# words are mapped to integer term ids, and every document is a run of
+# non-zeros (term id, raw count), kept in the order they were added. the
+# non-zeros live in two Segments: a large base segment, and a small delta
+# segment holding the latest additions, which is merged into the base once it
+# reaches g_delta_size non-zeros. both are indexed by term, so a cosine query
+# only touches the postings of its own terms, and the best k of those are taken
+# with a bounded heap.
+# only raw counts, their tf part 1 + log tf and df are stored; the idf
+# log(N / df) is applied when a query is scored, so adding, updating or
+# deleting a document never reweights the corpus. the L2 norms, which do depend
+# on idf, are derived from three sums per document (see UpdateNorms), and only
+# the sums of the documents sharing a term whose df changed are touched.
+# deleted documents and the replaced words of updated ones are tombstoned
+# (count 0) until Compact drops them; it runs on its own once
+# g_compact_fraction of the non-zeros are tombstones. document indices never
+# change, and the index of a deleted document is not reused.
+# batches of queries are one sparse query matrix, multiplied with the corpus
+# through the inverted index chunk by chunk (see GetBatchTopK).
+# only numpy is used.
+
+
+class SparseTFIDF:
+
+    def __init__(self):
+        self.vocabulary = {}
+        self.words = []
+
+        self.base = Segment.Empty()
+        self.delta = Segment.Empty()
+
+        # non-zeros added since the last Flush: blocks of (term ids, counts)
+        # arrays followed by the term ids and counts of the documents added one
+        # at a time, and (document, first position, end position) of the
+        # documents they belong to. positions number the non-zeros of base,
+        # delta and pending, in this order.
+        self.pending_blocks = []
+        self.pending_indices = []
+        self.pending_counts = []
+        self.pending_documents = []
+        self.pending_size = 0
+
+        # document indices handed out, deleted documents included, and the
+        # number of documents that are not deleted, the N of the idf
+        self.number_of_documents = 0
+        self.number_of_live_documents = 0
+
+        # per document: positions starts[i]:ends[i] of its non-zeros, whether it
+        # is not deleted, and the sums over its non-zeros of tf^2, tf^2 log df
+        # and tf^2 log^2 df (see UpdateNorms)
+        self.starts = numpy.zeros(0, dtype=numpy.int64)
+        self.ends = numpy.zeros(0, dtype=numpy.int64)
+        self.alive = numpy.zeros(0, dtype=bool)
+        self.tf_squares = numpy.zeros(0, dtype=float)
+        self.log_sums = numpy.zeros(0, dtype=float)
+        self.log_square_sums = numpy.zeros(0, dtype=float)
+
+        # per term: live documents containing it, log(df) as of the last Flush,
+        # and idf
+        self.df = numpy.zeros(0, dtype=numpy.int64)
+        self.log_df = numpy.zeros(0, dtype=float)
+        self.idf = numpy.zeros(0, dtype=float)
+
+        self.norms = numpy.zeros(0, dtype=float)
+        self.tombstones = 0
+        self.dirty = False
+
+        # derived from the weights and dropped on every change: (rows, term ids,
+        # weights) of the live non-zeros, and p -> sum of |weight|^p of every
+        # document row, for batched distances
+        self.matrix = None
+        self.norm_powers = {}
+
+    # build the engine from a list of word dicts, as returned by DocumentProcessor.
+    @staticmethod
+    def FromWordDicts(word_dicts):
+        engine = SparseTFIDF()
+        engine.Build(word_dicts)
+        return engine
+
+    # build the engine from raw document strings, tokenized in a process pool
+    # (see AddDocuments).
+    @staticmethod
+    def FromDocuments(doc_strings, processes = None):
+        engine = SparseTFIDF()
+        engine.AddDocuments(doc_strings, processes)
+        engine.Compact()
+        return engine
+
+    def Build(self, word_dicts):
+        for word_dict in word_dicts:
+            self.AddDocument(word_dict)
+        self.Compact()
+
+    # add a document given as a word dict; returns its index.
+    def AddDocument(self, word_dict):
+        idx = self.number_of_documents
+        self.number_of_documents += 1
+        self.number_of_live_documents += 1
+        self.AddNonzeros(idx, word_dict)
+        return idx
+
+    # add raw document strings; returns the index of the first one, the others
+    # follow in order. the documents are split into chunks that are tokenized in
+    # a pool of `processes` processes (all cores by default), and the chunk
+    # vocabularies are merged into the index as the chunks come back in order.
+    def AddDocuments(self, doc_strings, processes = None):
+        first = self.number_of_documents
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        size = max(1, -(-len(doc_strings) // (processes * 4)))
+        chunks = [doc_strings[i:i + size] for i in range(0, len(doc_strings), size)]
+
+        if processes == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                self.AddChunk(*TokenizeChunk(chunk))
+        else:
+            with Pool(processes) as pool:
+                for result in pool.imap(TokenizeChunk, chunks):
+                    self.AddChunk(*result)
+        return first
+
+    # add the documents of one chunk tokenized by TokenizeChunk, mapping its
+    # local term ids to the vocabulary.
+    def AddChunk(self, words, indices, counts, lengths):
+        vocabulary = self.vocabulary
+        term_ids = numpy.empty(len(words), dtype=numpy.int64)
+        for i, word in enumerate(words):
+            term_id = vocabulary.get(word)
+            if term_id is None:
+                term_id = len(vocabulary)
+                vocabulary[word] = term_id
+                self.words.append(word)
+            term_ids[i] = term_id
+
+        first = self.number_of_documents
+        ends = len(self.base) + len(self.delta) + self.pending_size + numpy.cumsum(lengths)
+        self.SealPending()
+        self.pending_blocks.append((term_ids[indices], counts))
+        self.pending_documents.extend(zip(range(first, first + len(lengths)), (ends - lengths).tolist(), ends.tolist()))
+        self.pending_size += len(indices)
+
+        self.number_of_documents += len(lengths)
+        self.number_of_live_documents += len(lengths)
+        self.dirty = True
+
+    # replace the words of document idx.
+    def UpdateDocument(self, idx, word_dict):
+        self.CheckDocument(idx)
+        self.Tombstone(idx)
+        self.AddNonzeros(idx, word_dict)
+
+    # delete document idx; its index is not reused.
+    def DeleteDocument(self, idx):
+        self.CheckDocument(idx)
+        self.Tombstone(idx)
+        self.alive[idx] = False
+        self.number_of_live_documents -= 1
+
+    def CheckDocument(self, idx):
+        if self.pending_documents:
+            self.Flush()
+        if not (0 <= idx < self.number_of_documents and self.alive[idx]):
+            raise IndexError("no document " + str(idx))
+
+    def AddNonzeros(self, idx, word_dict):
+        vocabulary = self.vocabulary
+        indices = self.pending_indices
+        counts = self.pending_counts
+        start = len(self.base) + len(self.delta) + self.pending_size
+        size = len(indices)
+
+        for word, count in word_dict.items():
+            if count <= 0:
+                continue
+            term_id = vocabulary.get(word)
+            if term_id is None:
+                term_id = len(vocabulary)
+                vocabulary[word] = term_id
+                self.words.append(word)
+            indices.append(term_id)
+            counts.append(count)
+
+        self.pending_size += len(indices) - size
+        self.pending_documents.append((idx, start, len(self.base) + len(self.delta) + self.pending_size))
+        self.dirty = True
+
+    # close the term ids and counts of the documents added one at a time into a
+    # block, before a block of another source is appended.
+    def SealPending(self):
+        if self.pending_indices:
+            self.pending_blocks.append((numpy.array(self.pending_indices, dtype=numpy.int64),
+                                        numpy.array(self.pending_counts, dtype=numpy.int64)))
+            self.pending_indices = []
+            self.pending_counts = []
+
+    # tombstone the (flushed) non-zeros of document idx.
+    def Tombstone(self, idx):
+        start, end = int(self.starts[idx]), int(self.ends[idx])
+        offset = 0
+        for segment in (self.base, self.delta):
+            lo, hi = max(start - offset, 0), min(end - offset, len(segment))
+            if lo < hi:
+                positions = numpy.arange(lo, hi)
+                positions = positions[segment.counts[positions] > 0]
+                self.df[segment.indices[positions]] -= 1
+                segment.Tombstone(positions)
+                self.tombstones += len(positions)
+            offset += len(segment)
+
+        self.tf_squares[idx] = self.log_sums[idx] = self.log_square_sums[idx] = 0
+        self.dirty = True
+
+    # (indices into term_ids, documents, tf) of the postings of the given terms
+    # in both segments.
+    def GetPostings(self, term_ids):
+        term_index = []
+        docs = []
+        tf = []
+        for segment in (self.base, self.delta):
+            positions, lengths = segment.GetPostingPositions(term_ids)
+            term_index.append(numpy.repeat(numpy.arange(len(term_ids)), lengths))
+            docs.append(segment.postings_docs[positions])
+            tf.append(segment.postings_tf[positions])
+        return numpy.concatenate(term_index), numpy.concatenate(docs), numpy.concatenate(tf)
+
+    # move the pending non-zeros into the delta segment, grow the per-document
+    # and per-term arrays and count the new non-zeros in df; returns the new
+    # non-zeros as (rows, term ids, counts).
+    def MovePending(self):
+        number_of_terms = len(self.words)
+
+        self.SealPending()
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        indices = numpy.concatenate([empty] + [block[0] for block in self.pending_blocks])
+        counts = numpy.concatenate([empty] + [block[1] for block in self.pending_blocks])
+        documents = numpy.array(self.pending_documents, dtype=numpy.int64).reshape(-1, 3)
+        rows = numpy.repeat(documents[:, 0], documents[:, 2] - documents[:, 1])
+        self.pending_blocks = []
+        self.pending_documents = []
+        self.pending_size = 0
+
+        grow = self.number_of_documents - len(self.alive)
+        self.starts = numpy.r_[self.starts, numpy.zeros(grow, dtype=numpy.int64)]
+        self.ends = numpy.r_[self.ends, numpy.zeros(grow, dtype=numpy.int64)]
+        self.alive = numpy.r_[self.alive, numpy.ones(grow, dtype=bool)]
+        self.tf_squares = numpy.r_[self.tf_squares, numpy.zeros(grow)]
+        self.log_sums = numpy.r_[self.log_sums, numpy.zeros(grow)]
+        self.log_square_sums = numpy.r_[self.log_square_sums, numpy.zeros(grow)]
+        self.starts[documents[:, 0]] = documents[:, 1]
+        self.ends[documents[:, 0]] = documents[:, 2]
+
+        grow = number_of_terms - len(self.df)
+        self.df = numpy.r_[self.df, numpy.zeros(grow, dtype=numpy.int64)]
+        self.log_df = numpy.r_[self.log_df, numpy.zeros(grow)]
+        self.df += numpy.bincount(indices, minlength=number_of_terms)
+
+        if len(rows):
+            self.delta = self.delta.Merge(Segment.FromNonzeros(rows, indices, counts, number_of_terms), number_of_terms)
+        return rows, indices, counts
+
+    # flush the pending non-zeros and bring idf and the norms up to date. the
+    # norm of a document depends on the df of its terms, so only the sums of
+    # the documents holding a term whose df changed are adjusted, through the
+    # postings of those terms; the new non-zeros enter the sums with the
+    # previous df and are adjusted with the others.
+    def Flush(self):
+        if not self.dirty:
+            return
+
+        rows, indices, counts = self.MovePending()
+        squares = GetTF(counts) ** 2
+        previous = self.log_df[indices]
+        self.tf_squares += numpy.bincount(rows, weights=squares, minlength=self.number_of_documents)
+        self.log_sums += numpy.bincount(rows, weights=squares * previous, minlength=self.number_of_documents)
+        self.log_square_sums += numpy.bincount(rows, weights=squares * previous ** 2, minlength=self.number_of_documents)
+
+        # tombstoned postings have tf 0 and are left as they are
+        log_df = numpy.log(numpy.maximum(self.df, 1))
+        changed = numpy.flatnonzero(log_df != self.log_df)
+        if len(changed):
+            term_index, docs, tf = self.GetPostings(changed)
+            squares = tf ** 2
+            shift = (log_df - self.log_df)[changed][term_index]
+            square_shift = (log_df ** 2 - self.log_df ** 2)[changed][term_index]
+            self.log_sums += numpy.bincount(docs, weights=squares * shift, minlength=self.number_of_documents)
+            self.log_square_sums += numpy.bincount(docs, weights=squares * square_shift, minlength=self.number_of_documents)
+        self.log_df = log_df
+
+        self.UpdateNorms()
+        self.dirty = False
+
+    # idf and the L2 norms of the documents. with L = log N and l = log df,
+    # |d|^2 = sum of tf^2 (L - l)^2 = L^2 sum tf^2 - 2 L sum tf^2 l + sum tf^2 l^2,
+    # so a change of N alone only needs the three sums.
+    def UpdateNorms(self):
+        L = numpy.log(max(self.number_of_live_documents, 1))
+        self.idf = L - self.log_df
+        squares = L * L * self.tf_squares - 2 * L * self.log_sums + self.log_square_sums
+        # a document whose terms all have idf 0 is left with rounding noise
+        squares[squares <= 1e-12 * L * L * self.tf_squares] = 0
+        self.norms = numpy.sqrt(squares)
+
+        self.matrix = None
+        self.norm_powers = {}
+
+    # bring the index up to date before a query: flush, merge the delta segment
+    # into the base segment once it is large, and compact once there are many
+    # tombstones.
+    def Refresh(self):
+        if not self.dirty:
+            return
+        self.Flush()
+
+        if len(self.delta) > g_delta_size:
+            self.base = self.base.Merge(self.delta, len(self.words))
+            self.delta = Segment.Empty()
+        if self.tombstones > g_compact_fraction * (len(self.base) + len(self.delta)):
+            self.Compact()
+
+    # merge everything into the base segment, drop the tombstones and recompute
+    # the per-document sums exactly, which also clears the rounding drift of the
+    # incremental updates. document indices do not change.
+    def Compact(self):
+        self.MovePending()
+        number_of_terms = len(self.words)
+        segment = self.base.Merge(self.delta, number_of_terms)
+
+        if self.tombstones:
+            live = segment.counts > 0
+            prefix = numpy.r_[0, numpy.cumsum(live)]
+            self.starts = prefix[self.starts]
+            self.ends = prefix[self.ends]
+            segment = Segment.FromNonzeros(segment.rows[live], segment.indices[live], segment.counts[live], number_of_terms)
+            self.tombstones = 0
+
+        self.base = segment
+        self.delta = Segment.Empty()
+
+        self.df = numpy.bincount(segment.indices, minlength=number_of_terms)
+        self.log_df = numpy.log(numpy.maximum(self.df, 1))
+        squares = GetTF(segment.counts) ** 2
+        log_df = self.log_df[segment.indices]
+        self.tf_squares = numpy.bincount(segment.rows, weights=squares, minlength=self.number_of_documents)
+        self.log_sums = numpy.bincount(segment.rows, weights=squares * log_df, minlength=self.number_of_documents)
+        self.log_square_sums = numpy.bincount(segment.rows, weights=squares * log_df ** 2, minlength=self.number_of_documents)
+        self.UpdateNorms()
+        self.dirty = False
+
+    # (rows, term ids, weights) of the live non-zeros, for the dense scorers.
+    def GetMatrix(self):
+        self.Refresh()
+        if self.matrix is None:
+            rows = numpy.concatenate((self.base.rows, self.delta.rows))
+            indices = numpy.concatenate((self.base.indices, self.delta.indices))
+            counts = numpy.concatenate((self.base.counts, self.delta.counts))
+            live = counts > 0
+            self.matrix = (rows[live], indices[live], GetTF(counts[live]) * self.idf[indices[live]])
+        return self.matrix
+
+    # (term ids, weights) of a query given as a string or a word dict; words
+    # that are not in the vocabulary, or only in deleted documents, have no
+    # weight and are dropped.
+    def GetQueryVector(self, query):
+        self.Refresh()
+        if type(query) is str:
+            query = DocumentProcessor(query)
+
+        term_ids = []
+        counts = []
+        for word, count in query.items():
+            term_id = self.vocabulary.get(word)
+            if term_id is not None and count > 0:
+                term_ids.append(term_id)
+                counts.append(count)
+
+        term_ids = numpy.array(term_ids, dtype=numpy.int64)
+        counts = numpy.array(counts, dtype=numpy.int64)
+        keep = self.df[term_ids] > 0
+        term_ids, counts = term_ids[keep], counts[keep]
+        return term_ids, GetTF(counts) * self.idf[term_ids]
+
+    # same as GetQueryVector, as a dense vector over the vocabulary.
+    def GetDenseQueryVector(self, query):
+        term_ids, weights = self.GetQueryVector(query)
+        dense = numpy.zeros(len(self.words), dtype=float)
+        dense[term_ids] = weights
+        return dense
+
+    # dot products of a dense query vector with every document row.
+    def GetDotProducts(self, dense):
+        rows, indices, data = self.GetMatrix()
+        return numpy.bincount(rows, weights=data * dense[indices], minlength=self.number_of_documents)
+
+    # Minkowski distances of a dense query vector to every document row:
+    # |d - q|^dim over the document's non-zeros, plus |q|^dim of the query terms
+    # the document does not contain. a document holding all the query terms gets
+    # no remainder, so identical vectors are at distance 0 exactly.
+    def GetMinkowskiDistances(self, dense, dim):
+        rows, indices, data = self.GetMatrix()
+        q = dense[indices]
+        inner = numpy.bincount(rows, weights=numpy.abs(data - q) ** dim, minlength=self.number_of_documents)
+        present = numpy.bincount(rows, weights=numpy.abs(q) ** dim, minlength=self.number_of_documents)
+        matched = numpy.bincount(rows, weights=q != 0, minlength=self.number_of_documents)
+        missing = numpy.maximum((numpy.abs(dense) ** dim).sum() - present, 0)
+        missing[matched == numpy.count_nonzero(dense)] = 0
+        distances = (inner + missing) ** (1 / dim)
+        distances[~self.alive] = numpy.nan
+        return distances
+
+    # score of every document against the query, with the metrics of
+    # CalculateDistance; NaN where a cosine is undefined (an all-zero vector)
+    # and for deleted documents.
+    def GetScores(self, query, metric = "cosine", dim = 3):
+        dense = self.GetDenseQueryVector(query)
+
+        if metric == "cosine":
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return self.GetDotProducts(dense) / (self.norms * numpy.linalg.norm(dense))
+        if metric == "euclidean":
+            return self.GetMinkowskiDistances(dense, 2)
+        if metric == "minkowski":
+            return self.GetMinkowskiDistances(dense, dim)
+
+        raise ValueError("unknown metric " + metric)
+
+    # cosine scores of the documents sharing at least one term with the query,
+    # from the postings of the query terms only; returns (doc ids, scores).
+    def GetCandidateScores(self, query):
+        term_ids, weights = self.GetQueryVector(query)
+        query_norm = numpy.linalg.norm(weights)
+        if query_norm == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=float)
+
+        # the idf of the document side is applied once per query term
+        term_index, hits, tf = self.GetPostings(term_ids)
+        scale = weights * self.idf[term_ids]
+        dots = numpy.bincount(hits, weights=tf * scale[term_index], minlength=self.number_of_documents)
+        docs = numpy.flatnonzero(dots > 0)
+        return docs, dots[docs] / (self.norms[docs] * query_norm)
+
+    # best k (document index, score) pairs, in the order of GetRanking, through a
+    # bounded heap. cosine queries only score the documents found through the
+    # inverted index; if there are fewer than k of them, the list is completed
+    # with the other documents at score 0, as GetRanking would rank them.
+    def GetTopK(self, query, k, metric = "cosine"):
+        if metric != "cosine":
+            scores = self.GetScores(query, metric)
+            valid = numpy.flatnonzero(~numpy.isnan(scores))
+            return [(idx, score) for score, idx in heapq.nsmallest(k, zip(scores[valid].tolist(), valid.tolist()))]
+
+        docs, scores = self.GetCandidateScores(query)
+        if len(docs) == 0:
+            return []
+
+        # only the candidates reaching the k-th best score can enter the heap
+        if len(docs) > k:
+            kth = numpy.partition(scores, len(scores) - k)[len(scores) - k]
+            keep = scores >= kth
+            docs, scores = docs[keep], scores[keep]
+
+        # ties are broken by document index, as in the stable sort of GetRanking
+        result = heapq.nlargest(k, zip(scores.tolist(), (-docs).tolist()))
+        result = [(-negative_idx, score) for score, negative_idx in result]
+
+        if len(result) < k:
+            others = numpy.ones(self.number_of_documents, dtype=bool)
+            others[docs] = False
+            others &= self.norms > 0
+            result += [(idx, 0.0) for idx in numpy.flatnonzero(others)[:k - len(result)].tolist()]
+
+        return result
+
+    # (document index, score) pairs in the order of GetRanking: descending for
+    # cosine, ascending for the distances, without NaN scores. with k, only the
+    # best k are returned (see GetTopK).
+    def GetRanking(self, query, metric = "cosine", k = None):
+        if k is not None:
+            return self.GetTopK(query, k, metric)
+
+        scores = self.GetScores(query, metric)
+        valid = numpy.flatnonzero(~numpy.isnan(scores))
+        order = numpy.argsort(-scores[valid] if metric == "cosine" else scores[valid], kind='stable')
+        return list(zip(valid[order].tolist(), scores[valid][order].tolist()))
+
+    # CSR matrix of a batch of queries (strings or word dicts):
+    # (indptr, term ids, weights).
+    def GetQueryMatrix(self, queries):
+        indptr = [0]
+        term_ids = [numpy.zeros(0, dtype=numpy.int64)]
+        weights = [numpy.zeros(0, dtype=float)]
+        for query in queries:
+            ids, w = self.GetQueryVector(query)
+            term_ids.append(ids)
+            weights.append(w)
+            indptr.append(indptr[-1] + len(ids))
+        return numpy.array(indptr, dtype=numpy.int64), numpy.concatenate(term_ids), numpy.concatenate(weights)
+
+    # p-th powers of the document p-norms, cached per p.
+    def GetNormPowers(self, dim):
+        powers = self.norm_powers.get(dim)
+        if powers is None:
+            rows, indices, data = self.GetMatrix()
+            powers = numpy.bincount(rows, weights=numpy.abs(data) ** dim, minlength=self.number_of_documents)
+            self.norm_powers[dim] = powers
+        return powers
+
+    # scores of queries [first, last) of a query matrix against every document,
+    # as a dense (last - first) x documents block. every query non-zero is paired
+    # with the postings of its term, which is the sparse product of the query
+    # rows and the transposed corpus; the Minkowski distances are derived from
+    # the same pairs as |d|^p + |q|^p + sum over shared terms of
+    # (|d - q|^p - |d|^p - |q|^p), to which tombstoned postings (d = 0) add
+    # nothing.
+    def GetBatchScores(self, query_matrix, first, last, metric = "cosine", dim = 3):
+        indptr, term_ids, weights = query_matrix
+        number_of_queries = last - first
+        lo, hi = indptr[first], indptr[last]
+
+        query_rows = numpy.repeat(numpy.arange(number_of_queries), numpy.diff(indptr[first:last + 1]))
+        term_index, docs, tf = self.GetPostings(term_ids[lo:hi])
+        cells = query_rows[term_index] * self.number_of_documents + docs
+        d = tf * self.idf[term_ids[lo:hi]][term_index]
+        q = weights[lo:hi][term_index]
+        size = number_of_queries * self.number_of_documents
+
+        if metric == "cosine":
+            dots = numpy.bincount(cells, weights=d * q, minlength=size).reshape(number_of_queries, -1)
+            query_norms = numpy.sqrt(numpy.bincount(query_rows, weights=weights[lo:hi] ** 2, minlength=number_of_queries))
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return dots / (query_norms[:, None] * self.norms[None, :])
+
+        if metric == "euclidean":
+            dim = 2
+        elif metric != "minkowski":
+            raise ValueError("unknown metric " + metric)
+
+        shared = numpy.bincount(cells, weights=numpy.abs(d - q) ** dim - numpy.abs(d) ** dim - numpy.abs(q) ** dim,
+                                minlength=size).reshape(number_of_queries, -1)
+        query_powers = numpy.bincount(query_rows, weights=numpy.abs(weights[lo:hi]) ** dim, minlength=number_of_queries)
+        total = self.GetNormPowers(dim)[None, :] + query_powers[:, None] + shared
+        distances = numpy.maximum(total, 0) ** (1 / dim)
+        distances[:, ~self.alive] = numpy.nan
+        return distances
+
+    # top k documents of every query of a batch, as two len(queries) x k arrays:
+    # document indices (-1 where a query has fewer than k results) and scores
+    # (NaN there), in the order of GetRanking. queries are processed in chunks
+    # bounded by g_batch_pairs expanded pairs and g_batch_cells score cells, so
+    # memory does not grow with the batch.
+    def GetBatchTopK(self, queries, k, metric = "cosine", dim = 3):
+        query_matrix = self.GetQueryMatrix(queries)
+        indptr, term_ids, weights = query_matrix
+        number_of_queries = len(indptr) - 1
+
+        # expanded pairs per query
+        pairs = numpy.bincount(numpy.repeat(numpy.arange(number_of_queries), numpy.diff(indptr)),
+                               weights=self.df[term_ids], minlength=number_of_queries)
+        cumulative = numpy.r_[0, numpy.cumsum(pairs)]
+        max_rows = max(1, g_batch_cells // max(1, self.number_of_documents))
+
+        top_docs = numpy.full((number_of_queries, k), -1, dtype=numpy.int64)
+        top_scores = numpy.full((number_of_queries, k), numpy.nan)
+
+        first = 0
+        while first < number_of_queries:
+            last = int(numpy.searchsorted(cumulative, cumulative[first] + g_batch_pairs, side='right')) - 1
+            last = min(max(last, first + 1), first + max_rows, number_of_queries)
+
+            scores = self.GetBatchScores(query_matrix, first, last, metric, dim)
+            top_docs[first:last], top_scores[first:last] = SelectTopK(scores, k, descending = (metric == "cosine"))
+            first = last
+
+        return top_docs, top_scores
+
+    # {word : weight} of one document, the sparse counterpart of the entries of
+    # the tfidf_vec_dict of TFIDFProcessor; {} for a deleted document.
+    def GetDocumentTFIDF(self, idx):
+        self.Refresh()
+        # the non-zeros of a document are all in one segment
+        start, end = int(self.starts[idx]), int(self.ends[idx])
+        segment = self.base
+        if start >= len(self.base):
+            segment = self.delta
+            start, end = start - len(self.base), end - len(self.base)
+
+        indices = segment.indices[start:end]
+        counts = segment.counts[start:end]
+        live = counts > 0
+        weights = GetTF(counts[live]) * self.idf[indices[live]]
+        return { self.words[t] : w for t, w in zip(indices[live].tolist(), weights.tolist()) }
@@ -12,13 +12,11 @@ g_number_of_results = 50
 
 class TFIDFApp:
 
-    def __init__(self, doc_strings, file_names, dict_tf_idf, dict_df, tfidf_vec_dict):
+    def __init__(self, doc_strings, file_names, engine):
 
         self.doc_strings = doc_strings
         self.file_names = file_names
-        self.dict_tf_idf = dict_tf_idf
-        self.dict_df = dict_df
-        self.tfidf_vec_dict = tfidf_vec_dict
+        self.engine = engine
         self.number_of_documents = len(self.file_names)
         self.labels = []
 
@@ -109,11 +107,8 @@ class TFIDFApp:
             print("query is empty")
             return
 
-        # query
-        query_tf_idf = GetQueryTFIDF(self.dict_tf_idf, self.dict_df, query_document, self.number_of_documents)
-
-        # get sorted results
-        sorted_result = GetRanking(query_tf_idf, self.tfidf_vec_dict, metric = "cosine")
+        # query and get sorted results
+        sorted_result = self.engine.GetRanking(query_document, metric = "cosine", k = g_number_of_results)
 
         # create string to show:
         show_string = " Query result\n"
@@ -1,4 +1,5 @@
 from SimpleTFIDF import *
+from SparseTFIDF import SparseTFIDF
 from DataPreprocessor import *
 from UIHelper import *
 
@@ -14,11 +15,10 @@ def main():
     # process files, get doc strings and group labels
     doc_strings, group_labels = ProcessFiles(file_names)
 
-    word_dicts = list(map(DocumentProcessor, doc_strings))
-    number_of_documents = len(word_dicts)
-    dict_tf_idf, dict_df, tfidf_vec_dict = TFIDFProcessor(word_dicts)
+    # sparse index of the corpus, tokenized in a process pool
+    engine = SparseTFIDF.FromDocuments(doc_strings)
 
-    TFIDFApp(doc_strings, file_names, dict_tf_idf, dict_df, tfidf_vec_dict)
+    TFIDFApp(doc_strings, file_names, engine)
 
 
 if __name__ == '__main__':